@@ -2,60 +2,55 @@
 
 
 # Utility libraries:
-from os import times_result
 import numpy as np
-import matplotlib.pyplot as plt
 import math, re, warnings
-from logging import raiseExceptions
-import os
-import requests
+from collections import deque
+from contextlib import closing, contextmanager, nullcontext, redirect_stdout
+import os, stat, sys
+import argparse
+import hashlib, json, time
+import multiprocessing, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # ezdxf libraries:
 import ezdxf
-from ezdxf.enums import TextEntityAlignment
-from ezdxf import path
+from ezdxf.filemanagement import dxf_file_info
+from ezdxf.lldxf.validator import is_binary_dxf_file
+from ezdxf.lldxf.types import DXFTag
+from ezdxf.lldxf.tagger import tag_compiler
+from ezdxf.lldxf.extendedtags import ExtendedTags
+from ezdxf.entities import factory
 
 # shapely libraries:
-from shapely.geometry import Point, Polygon, LineString
-from shapely import plotting, contains_properly, intersects
+from shapely.geometry import Polygon, LineString, MultiLineString
+from shapely import contains_properly, contains_xy, intersects, distance, polygons, prepare, get_parts, get_coordinates, union_all, to_wkb, from_wkb
+from shapely import points as shapely_points
+from shapely.ops import polylabel
 
 
 #----FUNCTION DEFINITIONS----
 
-def store_files_in_dict(folder_path):
+def iter_dxf_files(folder_path):
     '''
-    str -> dict
-
-    Reads all non-hidden files from a specified folder and stores them in a dictionary.
-
-    Args:
-        folder_path (str): The path to the folder.
+    str -> generator(str)
 
-    Returns:
-        dict: A dictionary where keys are filenames and values are the file contents.
+    Lazily yields the path of each non-hidden DXF file in a specified folder, in name order.
+    The files themselves are not read, so they are only parsed once when they are labelled.
     '''
-    file_contents_dict = {}
-
     if not os.path.isdir(folder_path):
         print(f"Error: The folder at '{folder_path}' does not exist.")
-        return file_contents_dict
+        return
 
-    for filename in os.listdir(folder_path):
-        # Skip hidden files like .DS_Store
-        if filename.startswith('.'):
+    for filename in sorted(os.listdir(folder_path)):
+        # Skip hidden files like .DS_Store and anything that isn't a DXF
+        if filename.startswith('.') or not filename.lower().endswith('.dxf'):
             continue
 
         file_path = os.path.join(folder_path, filename)
 
         if os.path.isfile(file_path):
-            try:
-                # Open the file in binary mode to handle all file types
-                with open(file_path, 'rb') as f:
-                    file_contents_dict[filename] = f.read()
-            except IOError as e:
-                print(f"Could not read file {filename}: {e}")
-
-    return file_contents_dict
+            yield file_path
 
 
 def check_layers(msp, required_layers):
@@ -71,14 +66,27 @@ def check_layers(msp, required_layers):
     # Initilize a list to store the layer names
     layer_list = []
 
-    # Get the layer table object from the current msp
-    layers = doc.layers
+    # Get the layer table object from the document of the current msp
+    layers = msp.doc.layers
 
     # Iterate through each layer in the layer table
     for layer_name in layers:
         # Add the layer's name to the list
         layer_list.append(layer_name.dxf.name)
 
+    check_layer_list(layer_list, required_layers)
+
+
+def check_layer_list(layer_list, required_layers):
+    '''
+    list(str), list(str) -> None
+
+    Makes sure all required layers are in a list of the layer names of a file.
+
+    Raises an exception if:
+      - a required layer is not found
+      - no layers are found
+    '''
     # Make sure the required layers are present
     for layer_requirement in required_layers:
         if not layer_requirement in layer_list:
@@ -88,193 +96,271 @@ def check_layers(msp, required_layers):
     assert len(layer_list) != 0, 'No layers found in file'
 
 
-def sort_curves(vertices_list):
+def point_key(point):
     '''
-    list(list(tuple)) -> list(list(tuple))
+    tuple -> tuple
 
-    Joins curves and speparates independent contours
+    Rounds a point so that coincident points from different contours compare (and hash) equal
     '''
-    # initiate an index
-    i = 0
-
-    # look at each contour in vertices_list, this is the reference curve
-    while i < len(vertices_list):
-        curve1 = vertices_list[i]
+    return (round(point[0], round_digits), round(point[1], round_digits))
 
-        # set/resent the merged indicator
-        merged = False
 
-        # initiate a sub-index
-        j = 0
-
-        # look at all the other contours in vertices list, this is the comparison curve
-        while j < len(vertices_list):
-            curve2 = vertices_list[j]
-
-            if curve1 is not curve2:
+def stitch_curves(vertices_list):
+    '''
+    list(list(tuple)) -> list(list(tuple)), list(tuple)
 
-                # if the curves share a startpoint, reverse the second one and join it with the first
-                if curve1[0] == curve2[0]:
-                    # remove the original curves for the replacement
-                    vertices_list.remove(curve1)
-                    vertices_list.remove(curve2)
+    Joins curves that share terminal points into contours and separates independent contours.
+    Each curve end is looked up in a dict keyed by its rounded endpoint, so this takes linear time in the number of curves.
 
-                    curve2.reverse()
+    Returns the contours and the terminal points of any contours that could not be closed
+    '''
+    # index each end of each curve by its rounded location: key -> list of (curve index, 0 for start / -1 for end)
+    ends = {}
+    for i, curve in enumerate(vertices_list):
+        ends.setdefault(point_key(curve[0]), []).append((i, 0))
+        ends.setdefault(point_key(curve[-1]), []).append((i, -1))
+
+    used = [False] * len(vertices_list)
+
+    def next_curve(point):
+        # find a curve that hasn't been joined yet with an end at point (each index entry is only looked at once)
+        candidates = ends.get(point_key(point), [])
+        while candidates:
+            i, end = candidates.pop()
+            if not used[i]:
+                used[i] = True
+                return vertices_list[i], end
+        return None, None
+
+    contours = []
+    open_ends = []
+
+    # start a new contour from each curve that hasn't been joined yet
+    for i, curve in enumerate(vertices_list):
+        if used[i]:
+            continue
+        used[i] = True
+
+        contour = deque(curve)
+
+        # keep joining curves onto the end of the contour until it closes or runs out of connections
+        while len(contour) < 2 or point_key(contour[-1]) != point_key(contour[0]):
+            next_one, end = next_curve(contour[-1])
+            if next_one is None:
+                break
+
+            # if the curves share an endpoint, reverse the next one before joining
+            if end == -1:
+                next_one = next_one[::-1]
+            contour.extend(next_one[1:])
+
+        # if the contour is still open, join curves onto its start instead
+        if point_key(contour[-1]) != point_key(contour[0]):
+            while point_key(contour[-1]) != point_key(contour[0]):
+                next_one, end = next_curve(contour[0])
+                if next_one is None:
+                    break
 
-                    vertices_list.append(curve2[0:-1] + curve1)
+                # if the curves share a startpoint, reverse the next one before joining
+                if end == 0:
+                    next_one = next_one[::-1]
+                contour.extendleft(reversed(next_one[:-1]))
 
-                    # if the comparison curve comes before the reference curve, adjust the comparison curve location
-                    if j < i:
-                        i -= 1
+            # record the terminal points of contours that couldn't be closed
+            if point_key(contour[-1]) != point_key(contour[0]):
+                open_ends.extend([contour[0], contour[-1]])
 
-                    # specify that two contours were merged
-                    merged = True
-                    break
+        contours.append(list(contour))
 
-                # if the curves share an endpoint, reverse the second one and join it with the first
-                if curve1[-1] == curve2[-1]:
-                    # remove the original curves for the replacement
-                    vertices_list.remove(curve1)
-                    vertices_list.remove(curve2)
+    return contours, open_ends
 
-                    curve2.reverse()
 
-                    vertices_list.append(curve1[0:-2] + curve2)
+def sort_curves(vertices_list):
+    '''
+    list(list(tuple)) -> list(list(tuple))
 
-                    # if the comparison curve comes before the reference curve, adjust the comparison curve location
-                    if j < i:
-                        i -= 1
+    Joins curves and speparates independent contours
+    '''
+    return stitch_curves(vertices_list)[0]
 
-                    # specify that two contours were merged
-                    merged = True
-                    break
 
-                # if the curves share an opposite terminal point, join them
-                if curve1[0] == curve2[-1]:
-                    # remove the original curves for the replacement
-                    vertices_list.remove(curve1)
-                    vertices_list.remove(curve2)
+def get_entity_vertices(entity):
+    '''
+    ezdxf entity -> np.array
 
-                    vertices_list.append(curve2[0:-2] + curve1)
+    Returns the vertices of a LINE, POLYLINE, LWPOLYLINE, CIRCLE, ARC, SPLINE or ELLIPSE entity as an (n, 2) array,
+    or None for any other entity type
+    '''
+    entity_type = entity.dxftype()
 
-                    # if the comparison curve comes before the reference curve, adjust the comparison curve location
-                    if j < i:
-                        i -= 1
+    if entity_type == 'LINE':
+        # each line is an independent contour
+        return np.array([(entity.dxf.start.x, entity.dxf.start.y),
+                         (entity.dxf.end.x, entity.dxf.end.y)])
 
-                    # specify that two contours were merged
-                    merged = True
-                    break
+    if entity_type == 'POLYLINE':
+        vertices = np.array([(vertex.dxf.location.x, vertex.dxf.location.y) for vertex in entity.vertices]).reshape(-1, 2)
 
-                # if the curves share an opposite terminal point, join them
-                if curve1[-1] == curve2[0]:
-                    # remove the original curves for the replacement
-                    vertices_list.remove(curve1)
-                    vertices_list.remove(curve2)
+        # repeat the first vertex of closed polylines so the contour is recognized as closed
+        if entity.is_closed and len(vertices) != 0:
+            vertices = np.vstack([vertices, vertices[:1]])
 
-                    # if the comparison curve comes before the reference curve, adjust the comparison curve location
-                    vertices_list.append(curve1[0:-1] + curve2)
+        return vertices
 
-                    if j < i:
-                        i -= 1  # adjust index if we removed earlier item
+    if entity_type == 'LWPOLYLINE':
+        vertices = np.array(entity.get_points('xy'), dtype=float).reshape(-1, 2)
 
-                    # specify that two contours were merged
-                    merged = True
-                    break
+        # repeat the first vertex of closed polylines so the contour is recognized as closed
+        if entity.closed and len(vertices) != 0:
+            vertices = np.vstack([vertices, vertices[:1]])
 
-            # look at the next curve to compare
-            j += 1
+        return vertices
 
-        # if no merge was accomplished with the reference curve, move to the next one. Otherwise the index will stay the same becuase the reference curve has been removed.
-        if not merged:
-            i += 1
+    if entity_type in ['CIRCLE', 'ARC', 'SPLINE', 'ELLIPSE']:
+        # slice the curve so no slice is further than chord_error from it (tight curves get more slices than gentle ones),
+        # rounding to ensure that coincident points are treated as such
+        return np.round(np.array([(point.x, point.y) for point in entity.flattening(chord_error)]).reshape(-1, 2),
+                        round_digits)
 
-    return vertices_list
+    return None
 
 
-def get_vertices(msp, layer_name):
+def get_layer_vertices(msp, layer_names):
     '''
-    ezdxf.layouts.layout.Modelspace, str -> list(list(tuple))
+    ezdxf.layouts.layout.Modelspace, list(str) -> dict
 
-    Returns a list of lists of vertices for each contour in the layer
+    Reads the vertices of every layer in layer_names in a single pass over the modelspace.
+    Returns a dict mapping each layer name to its contours, in the same form as get_vertices.
     '''
-    # init a list to store vertices of each contour
-    vertices_list = []
+    # bucket the vertices of each entity by layer (layer names are not case sensitive)
+    buckets = {layer_name.upper(): [] for layer_name in layer_names}
+    seen = {layer_name.upper(): set() for layer_name in layer_names}
 
-    # init a list to find which entity types need to be considered
-    entity_types_present = []
-
-    # iterate through each entity in the selected layer and add to the list
-    for entity in msp.query(f'*[layer == "{layer_name}"]'):
-        entity_types_present.append(entity.dxftype())
-
-    # remove duplicates from the entity list to get a list of which entity types are present
-    entity_types_present = list(set(entity_types_present))
+    for entity in msp:
+        layer = entity.dxf.get('layer', '0').upper()
+        if layer not in buckets:
+            continue
 
-    # look at each entity type
-    for entity_type in entity_types_present:
+        vertices = get_entity_vertices(entity)
+        if vertices is None or len(vertices) == 0:
+            continue
 
-        if entity_type == 'LINE':
-            # add each line to the vertices_list as an independent contour
-            for line in msp.query(f'LINE [layer == "{layer_name}"]'):
-                vertices_list.append([(line.dxf.start.x,
-                                       line.dxf.start.y),
-                                      (line.dxf.end.x,
-                                       line.dxf.end.y)])
+        # ensure that contours are not double counted
+        key = vertices.tobytes()
+        if key in seen[layer]:
+            continue
+        seen[layer].add(key)
 
-        if entity_type == 'POLYLINE':
-            # Query the polyline entities in the selected layer
-            for contour in msp.query(f'POLYLINE [layer == "{layer_name}"]'):
-                # Create a accumulator for the vertices set for this contour
-                vertices_accum = []
+        buckets[layer].append(vertices)
 
-                # Add each vertex to the accumulator
-                for vertex in contour.vertices:
-                    vertices_accum.append((vertex.dxf.location.x, vertex.dxf.location.y))
+    layer_vertices = {}
+    for layer_name in layer_names:
+        # stitch together connected curves and separate independent contours
+        sorted_list, open_ends = stitch_curves([list(map(tuple, vertices.tolist()))
+                                                for vertices in buckets[layer_name.upper()]])
 
-                # After each vertex for a contour is accumulated, add them to the vertices_list as a list
-                vertices_list.append(vertices_accum)
+        # ply boundaries must be closed, so report any ends that couldn't be matched
+        if len(open_ends) != 0 and layer_name in ['OUTER', 'INNER']:
+            warnings.warn(f'{len(open_ends)} unmatched contour ends in layer {layer_name}, e.g. at {open_ends[0]}')
 
-        if entity_type == 'LWPOLYLINE':
-            # Query the LWPOLYLINE entities in the selected layer
-            for contour in msp.query(f'LWPOLYLINE [layer == "{layer_name}"]'):
-                # Create a accumulator for the vertices set for this contour
-                vertices_accum = []
+        # remove the outer list brackets as long as the vertices_list has one element and is not in the 'INNER' layer
+        if len(sorted_list) == 1 and layer_name != 'INNER':
+            layer_vertices[layer_name] = sorted_list[0]
+        else:
+            layer_vertices[layer_name] = sorted_list
 
-                # Add each vertex to the accumulator
-                for vertex in contour.vertices():
-                    vertices_accum.append((float(vertex[0]), float(vertex[1])))
+    return layer_vertices
 
-                # After each vertex for a contour is accumulated, add them to the vertices_list as a set
-                vertices_list.append(vertices_accum)
 
-        if entity_type in ['CIRCLE', 'ARC', 'SPLINE', 'ELLIPSE']:
-            # look at each individual curve
-            for curve in msp.query(f'CIRCLE ARC SPLINE ELLIPSE [layer == "{layer_name}"]'):
-                # make a list to store the coordinates of each individual curve
-                sub_list = []
+def read_layer_entities(file_path, layer_names):
+    '''
+    str, list(str) -> list(str), list(ezdxf entity)
 
-                # slice the curve with the specified slice length
-                for point in curve.flattening(slice_length):
-                    # add each coordinate to the sub_list, rounding to ensure that coincident points are treated as such
-                    sub_list.append((round(point.x, round_digits), round(point.y, round_digits)))
+    Streams an ASCII DXF file and returns the names in its layer table, and the modelspace entities on the layers
+    in layer_names (not case sensitive) that get_entity_vertices can read. The entities on every other layer are
+    skipped without being parsed, so this is much faster than ezdxf.readfile on files with lots of other geometry.
+    The entities are not part of a document, so they can only be read, not changed or saved.
+    '''
+    # the encoding of the strings in the file comes from its header
+    encoding = dxf_file_info(file_path).encoding
 
-                vertices_list.append(sub_list)
+    wanted_layers = {layer_name.upper() for layer_name in layer_names}
+    wanted_types = {b'LINE', b'POLYLINE', b'LWPOLYLINE', b'CIRCLE', b'ARC', b'SPLINE', b'ELLIPSE'}
 
-    # ensure that contours are not double counted in the vertices_list
-    unique_list = []
-    for item in vertices_list:
-        if item not in unique_list:
-            unique_list.append(item)
+    layer_list = []
+    entity_tags = []
+    section = None
+    tags = []
+    keep_vertices = False
+
+    with open(file_path, 'rb') as f:
+        # the file is a list of group code / value line pairs
+        for code_line, value_line in zip(f, f):
+            code = int(code_line)
+            value = value_line.rstrip(b'\r\n')
+
+            if code != 0:
+                tags.append((code, value))
+
+                # the name of each section follows its SECTION tag
+                if code == 2 and tags[0][1] == b'SECTION':
+                    section = value
+
+                # and the name of each layer follows its LAYER table entry tag
+                elif code == 2 and tags[0][1] == b'LAYER' and section == b'TABLES':
+                    layer_list.append(value.decode(encoding, errors='surrogateescape'))
+
+                continue
+
+            # an entity is complete when the next one starts
+            if section == b'ENTITIES' and len(tags) != 0:
+                entity_type = tags[0][1]
+
+                # the VERTEX and SEQEND entities of a wanted POLYLINE are kept with it
+                if entity_type in (b'VERTEX', b'SEQEND'):
+                    if keep_vertices:
+                        entity_tags[-1].append(tags)
+
+                else:
+                    layer = next((tag_value for tag_code, tag_value in tags if tag_code == 8), b'0')
+                    paperspace = any(tag_code == 67 and tag_value.strip() == b'1' for tag_code, tag_value in tags)
+
+                    keep_vertices = (entity_type in wanted_types
+                                     and layer.decode(encoding, errors='surrogateescape').upper() in wanted_layers
+                                     and not paperspace)
+                    if keep_vertices:
+                        entity_tags.append([tags])
+
+            if value == b'ENDSEC':
+                section = None
+
+            tags = [(code, value)]
+
+    # only now parse the wanted entities, linking the vertices of each POLYLINE to it
+    entities = []
+    for group in entity_tags:
+        entity = None
+        for tags in group:
+            # the tag compiler looks one tag past each point, so end the entity with the tag of a next one
+            compiled_tags = list(tag_compiler(iter([DXFTag(tag_code, tag_value.decode(encoding, errors='surrogateescape'))
+                                                    for tag_code, tag_value in tags] + [DXFTag(0, 'EOF')])))
+            sub_entity = factory.load(ExtendedTags(compiled_tags[:-1]))
+            if entity is None:
+                entity = sub_entity
+            elif sub_entity.dxftype() == 'VERTEX':
+                entity.vertices.append(sub_entity)
+        entities.append(entity)
+
+    return layer_list, entities
 
-    # stitch together connected curves and separate independent contours
-    sorted_list = sort_curves(unique_list)
 
-    # remove the outer list brackets as long as the vertices_list has one element and is not in the 'INNER' layer
-    if len(sorted_list) == 1 and layer_name != 'INNER':
-        return sorted_list[0]
+def get_vertices(msp, layer_name):
+    '''
+    ezdxf.layouts.layout.Modelspace, str -> list(list(tuple))
 
-    else:
-        return sorted_list
+    Returns a list of lists of vertices for each contour in the layer
+    '''
+    return get_layer_vertices(msp, [layer_name])[layer_name]
 
 
 def get_ply_number(filename, ply_prefix):
@@ -335,6 +421,57 @@ def get_grid(bounds, num_x, num_y):
     return(grid_points)
 
 
+def get_sample_points(free_region, num_points):
+    '''
+    shapely.Polygon/MultiPolygon, int -> np.array, float
+
+    Spreads about num_points grid points over the inside of the free region instead of its bounding box, so no search
+    time is spent at points where a label can't be. The grid spacing starts from the area of the region and is made
+    finer until at least half of num_points land inside, so thin or diagonal plies still get points.
+    Returns the points (shape (n, 2), in rows from the bottom like get_grid) and the grid spacing.
+    '''
+    if free_region.is_empty or num_points < 1:
+        return np.zeros((0, 2)), 0
+
+    x_min, y_min, x_max, y_max = free_region.bounds
+    spacing = math.sqrt(free_region.area / num_points)
+    prepare(free_region)
+
+    for attempt in range(10):
+        # lay a grid of cell centers over the bounding box
+        x_coords = np.arange(x_min + spacing / 2, x_max, spacing)
+        y_coords = np.arange(y_min + spacing / 2, y_max, spacing)
+        x_grid, y_grid = np.meshgrid(x_coords, y_coords)
+
+        # keep the points inside the free region
+        inside = contains_xy(free_region, x_grid.ravel(), y_grid.ravel())
+        if np.count_nonzero(inside) >= num_points / 2:
+            break
+
+        # too few landed inside, try a finer grid
+        spacing /= math.sqrt(2)
+
+    return np.column_stack([x_grid.ravel()[inside], y_grid.ravel()[inside]]), spacing
+
+
+def order_by_clearance(points, free_region):
+    '''
+    np.array, shapely.Polygon/MultiPolygon -> np.array
+
+    Sorts n x 2 points by their distance to the edge of the free region, largest first, with the points outside it last.
+    A point with more room around it can hold a taller rectangle, so it is the more promising place to search.
+    The sort is stable, so points with the same clearance keep their order.
+    '''
+    if len(points) == 0:
+        return points
+
+    # distance to the nearest edge, rosette or marker, negative outside the region
+    clearance = distance(free_region.boundary, shapely_points(points))
+    clearance[~contains_xy(free_region, points[:, 0], points[:, 1])] *= -1
+
+    return points[np.argsort(-clearance, kind='stable')]
+
+
 def get_bbox(polygon: Polygon):
     '''
     shapely.geometry.polygon.Polygon -> tuple
@@ -346,11 +483,106 @@ def get_bbox(polygon: Polygon):
     return x_max, y_max, x_min, y_min
 
 
+def get_search_polygon(ply_polygon):
+    '''
+    shapely.Polygon -> shapely.Polygon/MultiPolygon
+
+    Makes a smaller version of the ply polygon for the search with as few vertices as possible. The polygon is shrunk by
+    chord_error + simplify_tolerance and then simplified (keeping its topology) so no vertex moves more than
+    simplify_tolerance, so the result stays inside the ply and inside the true curves that were flattened into it.
+    Returns the ply polygon itself if simplify_tolerance is 0 or the shrunk polygon would be empty.
+    '''
+    if simplify_tolerance <= 0:
+        return ply_polygon
+
+    # shrink the polygon by the error of the flattening and the simplification (mitred corners don't add vertices)
+    search_polygon = ply_polygon.buffer(-(chord_error + simplify_tolerance), join_style='mitre')
+    if search_polygon.is_empty:
+        return ply_polygon
+
+    return search_polygon.simplify(simplify_tolerance, preserve_topology=True)
+
+
+def get_line_geometry(contours):
+    '''
+    list -> shapely.LineString/MultiLineString
+
+    Makes the shapely geometry of an open layer like ROSETTE or MARKERS from its get_layer_vertices contours,
+    which are a single list of vertices when the layer has one contour and a list of them when it has several
+    (e.g. one tick per marker)
+    '''
+    if len(contours) != 0 and isinstance(contours[0], list):
+        return MultiLineString(contours)
+
+    return LineString(contours)
+
+
+def get_free_region(ply_polygon, ply_rosette, ply_markers):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString -> shapely.Polygon/MultiPolygon
+
+    Returns the region of the ply that a label could be placed in: the ply polygon minus the rosette and markers
+    thickened by the clearance margin. A rectangle fits the ply if the region contains it, so the searches check
+    candidates against this region alone. Returns ply_polygon itself if the rosette and markers are None
+    (it is already a free region).
+    '''
+    if ply_rosette is None and ply_markers is None:
+        return ply_polygon
+
+    # the rosette and markers are lines, so thicken them by the clearance (or slightly) to cut them out of the polygon.
+    # Mitred joins and square ends keep at least the clearance everywhere with fewer vertices than round ones
+    obstacles = union_all([ply_rosette, ply_markers]).buffer(max(clearance, 10 ** -round_digits),
+                                                            cap_style='square', join_style='mitre')
+
+    return ply_polygon.difference(obstacles)
+
+
+def get_height_bound(free_region, aspect_ratio):
+    '''
+    shapely.Polygon/MultiPolygon, float -> float, np.array, list
+
+    Uses the maximum inscribed circle (pole of inaccessibility) of each part of the free region to bound the height
+    of a rectangle with the given aspect ratio that can fit. Returns the upper bound, the circle centers,
+    which are good seeds for the search since a rectangle inscribed in the circle always fits there, and the
+    best_config of the largest of those inscribed rectangles (None if the region has no parts).
+    '''
+    max_height = 0
+    seed_points = []
+    inscribed_config = None
+
+    # a rectangle has to fit inside a single part of the free region
+    for part in get_parts(free_region):
+        if part.is_empty or part.geom_type != 'Polygon':
+            continue
+
+        # find the center and radius of the largest circle that fits in the part
+        pole = polylabel(part, tolerance=height_tolerance)
+        radius = part.boundary.distance(pole) + height_tolerance
+        seed_points.append((pole.x, pole.y))
+
+        # the rectangle's own inscribed circle (diameter = its shorter side) has to fit in that circle,
+        # and the rectangle can't have more area than the part
+        circle_bound = 2 * radius / min(1, aspect_ratio)
+        area_bound = math.sqrt(part.area / aspect_ratio)
+
+        max_height = max(max_height, min(circle_bound, area_bound))
+
+        # a rectangle whose diagonal spans the circle fits at any angle (made a touch smaller so it is strictly inside)
+        inscribed_height = 2 * (radius - height_tolerance) / math.sqrt(1 + aspect_ratio ** 2) * (1 - 1e-6)
+        if inscribed_config is None or inscribed_height > inscribed_config[1]:
+            inscribed_config = [np.array([pole.x, pole.y]), inscribed_height, 0.0]
+
+    return max_height, np.array(seed_points).reshape(-1, 2), inscribed_config
+
+
 def rect_check(ply_polygon, rectangle, ply_rosette, ply_markers):
     '''
     shapely.Polygon, shapely.Polygon, shapely.LineString, shapely.Linstring -> Boolean
 
     checks if the rectangle fits inside of the ply polygon and does not intersect with rosette or markers
+
+    If the rosette and markers are None, ply_polygon is a free region they are already cut out of (see get_free_region)
+    and only the containment is checked.
     '''
     # assume intersection
     output = False
@@ -358,46 +590,565 @@ def rect_check(ply_polygon, rectangle, ply_rosette, ply_markers):
     # check if the polygon contains the rectangle
     if contains_properly(ply_polygon, rectangle):
         # check if the rectangle intersects with the rosette
-        if not intersects(rectangle, ply_rosette):
+        if ply_rosette is None or not intersects(rectangle, ply_rosette):
             # check if the rectangle intersects with the markers
-            if not intersects(rectangle, ply_markers):
+            if ply_markers is None or not intersects(rectangle, ply_markers):
                 # if all this is true, set the output to true
                 output = True
 
+    count_stats(rectangles_checked=1, rectangles_fit=int(output))
+
     return output
 
 
 def get_rotated_rectangle(aspect_ratio, centroid, height, angle_degrees):
     '''
-    float, tuple, float, float -> shapely.Polygon
+    float, tuple, float, float -> shapely.Polygon, list(tuple)
+
+    Makes a rectangular Polygon object based on the specifications, and returns it with its list of corners
+    '''
+    corners = get_rectangle_corners(aspect_ratio, np.array([centroid], dtype=float), [height], [angle_degrees])[0]
+
+    return Polygon(corners), list(map(tuple, corners.tolist()))
+
+
+def get_rotation_table(aspect_ratio, angles_degrees):
+    '''
+    float, np.array -> dict
+
+    Rotates the corners of a rectangle of height 1 and the given aspect ratio, centered at (0, 0), to each of m angles.
+    Any rectangle at one of these angles is then just a scaled and translated copy of a row of the table, so the
+    sines and cosines are only found once per angle however many centers and heights are tried.
+    Returns a dict of the aspect_ratio, the angles (degrees) and the corner offsets (shape (m, 4, 2)).
+    '''
+    angles_degrees = np.asarray(angles_degrees, dtype=float)
+
+    # find the sines and cosines of all the angles once
+    theta = np.radians(angles_degrees)
+    cos_t = np.cos(theta)[:, None]
+    sin_t = np.sin(theta)[:, None]
+
+    # unrotated corners of the unit height rectangle, starting bottom left and going counterclockwise
+    x = np.array([-0.5, 0.5, 0.5, -0.5]) * aspect_ratio
+    y = np.array([-0.5, -0.5, 0.5, 0.5])
+
+    # rotate them to every angle
+    offsets = np.empty((len(angles_degrees), 4, 2))
+    offsets[:, :, 0] = x * cos_t - y * sin_t
+    offsets[:, :, 1] = x * sin_t + y * cos_t
+
+    return {'aspect_ratio': aspect_ratio, 'angles': angles_degrees, 'offsets': offsets}
+
+
+def get_table_corners(rotation_table, centers, heights, angle_index):
+    '''
+    dict, np.array, np.array, np.array -> np.array
+
+    Builds rectangle corners from a rotation table. centers (shape (..., 2)), heights and angle_index (indices into
+    the table's angles) are broadcast together, so n configurations give shape (n, 4, 2), and e.g. centers[:, None],
+    heights[:, None] and np.arange(m) give every angle at every center, shape (n, m, 4, 2).
+    '''
+    centers = np.asarray(centers, dtype=float)
+    heights = np.asarray(heights, dtype=float)
+
+    # scale the unit rectangles by the heights and move them to the centers
+    return rotation_table['offsets'][angle_index] * heights[..., None, None] + centers[..., None, :]
+
+
+def get_rectangle_corners(aspect_ratio, centroids, heights, angles_degrees):
+    '''
+    float, np.array, np.array, np.array -> np.array
+
+    Array version of get_rotated_rectangle. Takes n centroids (shape (n, 2)), n heights and n angles
+    and returns the corners of all n rectangles as an array of shape (n, 4, 2)
+    '''
+    return get_table_corners(get_rotation_table(aspect_ratio, angles_degrees), centroids, heights, np.arange(len(heights)))
 
-    Makes a rectangular Polygon object based on the specifications
+
+def check_rectangles(ply_polygon, corners, ply_rosette, ply_markers):
+    '''
+    shapely.Polygon, np.array, shapely.LineString, shapely.LineString -> np.array(bool)
+
+    Array version of rect_check. Builds all the rectangles in one call and returns a boolean array
+    that is True where the rectangle fits inside of the ply polygon and does not intersect with rosette or markers
+    (or only where it fits inside of the free region if the rosette and markers are None)
+    '''
+    # build every rectangle at once
+    rectangles = polygons(corners)
+
+    # check which rectangles are contained by the polygon
+    output = contains_properly(ply_polygon, rectangles)
+
+    # only check the rosette and markers for the rectangles that are still candidates
+    for obstacle in (ply_rosette, ply_markers):
+        if obstacle is None:
+            continue
+        candidates = np.flatnonzero(output)
+        output[candidates] = ~intersects(rectangles[candidates], obstacle)
+
+    count_stats(rectangles_checked=len(rectangles), rectangles_fit=int(np.count_nonzero(output)))
+
+    return output
+
+
+def check_configs(ply_polygon, ply_rosette, ply_markers, rotation_table, centers, heights, angle_index, batch_size):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, dict, np.array, np.array, np.array, int -> np.array(bool)
+
+    Checks n (center, height, angle) configurations in batches of at most batch_size rectangles
+    and returns a boolean array that is True where the rectangle fits. The angles are indices into the rotation_table.
+    '''
+    fits = np.zeros(len(heights), dtype=bool)
+
+    for start in range(0, len(heights), batch_size):
+        batch = slice(start, start + batch_size)
+        fits[batch] = check_rectangles(ply_polygon,
+                                       get_table_corners(rotation_table, centers[batch], heights[batch], angle_index[batch]),
+                                       ply_rosette,
+                                       ply_markers)
+
+    return fits
+
+
+def bisect_heights(ply_polygon, ply_rosette, ply_markers, rotation_table, centers, angle_index, low, high, batch_size):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, dict, np.array, np.array, float/np.array, float/np.array, int -> np.array
+
+    Finds the tallest fitting rectangle height between low and high (to within height_tolerance) for each of n (center, angle)
+    configurations (angle_index picks each angle from the rotation_table). For a fixed center and angle a rectangle that fits
+    means any smaller one fits, so the height can be bisected. Returns 0 for configurations where a rectangle of height low does not fit, since those can't beat low.
+    If the search budget runs out the bisection stops, returning the tallest height known to fit for each configuration.
+    '''
+    low = np.array(np.broadcast_to(low, len(centers)), dtype=float)
+    high = np.array(np.broadcast_to(high, len(centers)), dtype=float)
+    result = np.zeros(len(centers))
+
+    count_stats(configs_planned=len(centers))
+
+    def check(index, heights):
+        return check_configs(ply_polygon, ply_rosette, ply_markers, rotation_table,
+                             centers[index], heights, angle_index[index], batch_size)
+
+    # skip the configurations that can't fit a rectangle of height low
+    active = np.arange(len(centers))
+    active = active[check(active, low[active])]
+    survivors = active
+
+    # configurations that fit a rectangle of height high are done
+    fits = check(active, high[active])
+    low[active[fits]] = high[active[fits]]
+    active = active[~fits]
+
+    # bisect the rest until the bracket is smaller than the tolerance
+    while active.size and not budget_expired():
+        mid = (low[active] + high[active]) / 2
+        fits = check(active, mid)
+        low[active[fits]] = mid[fits]
+        high[active[~fits]] = mid[~fits]
+        active = active[high[active] - low[active] > height_tolerance]
+
+    result[survivors] = low[survivors]
+
+    count_stats(configs_searched=len(centers) - active.size)
+
+    return result
+
+
+def split_work(function, num_items, threads, geometries):
+    '''
+    function, int, int, tuple -> list
+
+    Splits the indices 0..num_items into contiguous chunks, one per thread, and calls function(index_array, *geometries)
+    for each chunk in a thread pool (shapely and numpy release the GIL). Returns the results in chunk order, so reducing
+    them in order gives the same answer however the threads are scheduled.
+
+    Prepared geometries can't be used by two threads at once, so each chunk gets its own prepared copy of the geometries.
+    '''
+    chunks = [index for index in np.array_split(np.arange(num_items), max(1, min(threads, num_items))) if index.size]
+
+    if len(chunks) <= 1:
+        return [function(index, *geometries) for index in chunks]
+
+    def run_chunk(index):
+        # copy and prepare the geometries for this thread
+        thread_geometries = from_wkb(to_wkb(list(geometries)))
+        prepare(thread_geometries)
+
+        return function(index, *thread_geometries)
+
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        return list(executor.map(run_chunk, chunks))
+
+
+def parallel_bisect_heights(ply_polygon, ply_rosette, ply_markers, rotation_table, centers, angle_index, low, high, batch_size):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, dict, np.array, np.array, float/np.array, float/np.array, int -> np.array
+
+    bisect_heights with the configurations split between search_threads threads
+    '''
+    low = np.broadcast_to(low, len(centers))
+    high = np.broadcast_to(high, len(centers))
+
+    def bisect_chunk(index, polygon, rosette, markers):
+        return bisect_heights(polygon, rosette, markers, rotation_table,
+                              centers[index], angle_index[index], low[index], high[index],
+                              batch_size)
+
+    return np.concatenate([np.zeros(0)] + split_work(bisect_chunk, len(centers), search_threads,
+                                                     (ply_polygon, ply_rosette, ply_markers)))
+
+
+def batch_search(ply_polygon, ply_rosette, ply_markers, aspect_ratio, grid_points, angles, max_height, batch_size):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, float, np.array, np.array, float, int -> list
+
+    Exhaustive nesting loop. For every grid point, bisects the rectangle height of every angle at once, starting from
+    the running max so configurations that can't beat the current best are skipped after a single check.
+    If the search budget runs out the remaining grid points are skipped (see order_by_clearance to try the best first).
+    Returns the best_config [point, rect_height, angle], or None if no rectangle fits.
+    '''
+    running_max = 0
+    best_config = None
+
+    # the same angles are tried at every point, so rotate the rectangle to each of them once
+    rotation_table = get_rotation_table(aspect_ratio, angles)
+    angle_index = np.arange(len(angles))
+
+    # for every point in the grid...
+    for i, point in enumerate(grid_points):
+        # stop at the best so far once the budget runs out
+        if i > 0 and budget_expired():
+            count_stats(configs_planned=(len(grid_points) - i) * len(angles))
+            break
+
+        #...find the tallest rectangle at every angle that beats the running max
+        heights = bisect_heights(ply_polygon, ply_rosette, ply_markers, rotation_table,
+                                 np.broadcast_to(point, (len(angles), 2)),
+                                 angle_index,
+                                 max(running_max, min_rect_height),
+                                 max_height,
+                                 batch_size)
+
+        # if the tallest of them is larger than the previous largest option, make it the new largest option
+        best = np.argmax(heights)
+        if heights[best] > running_max:
+            running_max = heights[best]
+            best_config = [point, heights[best], angles[best]]
+
+            # stop early once the upper bound on the height is reached
+            if running_max >= max_height - height_tolerance:
+                break
+
+    return best_config
+
+
+def adaptive_search(ply_polygon, ply_rosette, ply_markers, aspect_ratio, bounds, max_height, batch_size, seed_points=None, free_region=None):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, float, tuple, float, int, np.array, shapely.Polygon -> list
+
+    Coarse-to-fine version of the nesting loop. Runs a coarse pass over the bounding box, keeps the adaptive_top_k
+    tallest configurations, then refines the (x, y, angle) neighbourhood around them, halving the step each round
+    until it is below adaptive_tolerance and adaptive_angle_tolerance (or the search budget runs out).
+    Any seed_points are tried ahead of the coarse grid, and with the free_region the coarse points are tried
+    in order of their clearance.
+    If the free_region is given and sample_inside is set, the adaptive_grid x adaptive_grid coarse points are spread
+    over the free region instead of the bounding box.
+    Returns a best_config [point, rect_height, angle], or None if no rectangle fits.
+    '''
+    #----COARSE PASS----
+    if free_region is not None and sample_inside:
+        grid_points, spacing = get_sample_points(free_region, adaptive_grid ** 2)
+        x_step = y_step = spacing
+    else:
+        grid_points = get_grid(bounds, adaptive_grid, adaptive_grid)
+        x_step = (bounds[0] - bounds[2]) / max(adaptive_grid - 1, 1)
+        y_step = (bounds[1] - bounds[3]) / max(adaptive_grid - 1, 1)
+
+    if seed_points is not None:
+        grid_points = np.concatenate([seed_points, grid_points])
+    if free_region is not None:
+        grid_points = order_by_clearance(grid_points, free_region)
+    coarse_angles = np.linspace(0, 180, adaptive_angles, endpoint=False)
+
+    # try every coarse angle at every coarse grid point
+    centers = np.repeat(grid_points, len(coarse_angles), axis=0)
+    angle_index = np.tile(np.arange(len(coarse_angles)), len(grid_points))
+    angles = coarse_angles[angle_index]
+    rotation_table = get_rotation_table(aspect_ratio, coarse_angles)
+    heights = np.zeros(len(centers))
+
+    # with a search budget, bisect adaptive_top_k points at a time so the most promising are done before it runs out
+    # (each configuration is bisected on its own, so this gives the same heights as doing them all at once)
+    chunk_size = len(centers)
+    if search_time_limit is not None or search_check_limit is not None:
+        chunk_size = adaptive_top_k * len(coarse_angles)
+
+    for start in range(0, len(centers), chunk_size):
+        if start > 0 and budget_expired():
+            count_stats(configs_planned=len(centers) - start)
+            break
+
+        chunk = slice(start, start + chunk_size)
+        heights[chunk] = parallel_bisect_heights(ply_polygon, ply_rosette, ply_markers, rotation_table,
+                                                 centers[chunk], angle_index[chunk], min_rect_height, max_height,
+                                                 batch_size)
+
+    if not heights.any():
+        return None
+
+    # keep the tallest configurations (stable so ties keep the nesting loop order)
+    keep = np.argsort(-heights, kind='stable')[:adaptive_top_k]
+    keep = keep[heights[keep] > 0]
+    centers, angles, heights = centers[keep], angles[keep], heights[keep]
+
+    #----REFINEMENT----
+    # start from half of the coarse spacing in every direction
+    return refine_configs(ply_polygon, ply_rosette, ply_markers, aspect_ratio, centers, angles, heights,
+                          (x_step / 2, y_step / 2, 180 / adaptive_angles / 2), max_height, batch_size)
+
+
+def refine_configs(ply_polygon, ply_rosette, ply_markers, aspect_ratio, centers, angles, heights, steps, max_height, batch_size):
     '''
-    # define centroid x and y components
-    cx, cy = centroid
-    h = height
-    # calculate width based on height and aspect ratio
-    w = h * aspect_ratio
+    shapely.Polygon, shapely.LineString, shapely.LineString, float, np.array, np.array, np.array, tuple, float, int -> list
 
-    theta = math.radians(angle_degrees)  # Convert to radians
+    Refines the (x, y, angle) neighbourhood around configurations whose rectangle of the given heights fits,
+    keeping the adaptive_top_k tallest each round and halving the steps (x_step, y_step, angle_step) until they are
+    below adaptive_tolerance and adaptive_angle_tolerance, or the search budget runs out.
+    Returns the best_config [point, rect_height, angle].
+    '''
+    x_step, y_step, angle_step = steps
+
+    # every combination of stepping back, staying, or stepping forward in x, y and angle
+    offsets = np.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)], dtype=float)
+
+    while x_step > adaptive_tolerance or y_step > adaptive_tolerance or angle_step > adaptive_angle_tolerance:
+        # stop at the best so far once the budget runs out, counting the rounds left as not searched
+        if budget_expired():
+            rounds = 0
+            while x_step > adaptive_tolerance or y_step > adaptive_tolerance or angle_step > adaptive_angle_tolerance:
+                rounds += 1
+                x_step, y_step, angle_step = x_step / 2, y_step / 2, angle_step / 2
+            count_stats(configs_planned=rounds * len(centers) * len(offsets))
+            break
+
+        # build the neighbourhood of each kept configuration
+        new_centers = (centers[:, None, :] + offsets[None, :, :2] * [x_step, y_step]).reshape(-1, 2)
+        new_angles = ((angles[:, None] + offsets[None, :, 2] * angle_step) % 180).ravel()
+
+        # each neighbour only has to beat the configuration it came from, so its bisection starts there
+        # (the neighbours of a configuration share 3 angles, and each is rotated once for the whole bisection)
+        round_angles, angle_index = np.unique(new_angles, return_inverse=True)
+        new_heights = parallel_bisect_heights(ply_polygon, ply_rosette, ply_markers, get_rotation_table(aspect_ratio, round_angles),
+                                              new_centers, angle_index,
+                                              np.repeat(heights, len(offsets)), max_height,
+                                              batch_size)
+
+        # keep the tallest neighbours for the next round (the unmoved configurations are always candidates)
+        keep = np.argsort(-new_heights, kind='stable')[:adaptive_top_k]
+        centers, angles, heights = new_centers[keep], new_angles[keep], new_heights[keep]
+
+        # refine the neighbourhood
+        x_step /= 2
+        y_step /= 2
+        angle_step /= 2
+
+    return [centers[0], heights[0], angles[0]]
+
+
+def warm_start_search(ply_polygon, ply_rosette, ply_markers, aspect_ratio, warm_config, bounds, max_height, batch_size):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, float, list, tuple, float, int -> list
+
+    Starts the search from the best_config of a similar ply (e.g. the previous ply of a stack). If that rectangle
+    still fits, shrunk to no less than warm_start_shrink of its height, only its neighbourhood is searched,
+    starting from a quarter of the adaptive coarse spacing.
+    Returns the best_config, or None if the warm_config doesn't fit and a full search is needed.
+    '''
+    point, rect_height, angle = warm_config
+    rect_height = min(rect_height, max_height)
+    low = max(rect_height * warm_start_shrink, min_rect_height)
+
+    # verify the rectangle still fits this ply and text, shrinking it as the outline may have shrunk
+    if rect_height < low:
+        return None
+    if not rect_check(ply_polygon, get_rotated_rectangle(aspect_ratio, point, rect_height, angle)[0], ply_rosette, ply_markers):
+        rect_height = bisect_heights(ply_polygon, ply_rosette, ply_markers, get_rotation_table(aspect_ratio, [angle]),
+                                     np.array([point], dtype=float), np.array([0]), low, rect_height,
+                                     batch_size)[0]
+        if rect_height == 0:
+            return None
+
+    count_stats(warm_starts=1)
+
+    # search its neighbourhood
+    return refine_configs(ply_polygon, ply_rosette, ply_markers, aspect_ratio,
+                          np.array([point], dtype=float), np.array([angle], dtype=float), np.array([rect_height], dtype=float),
+                          ((bounds[0] - bounds[2]) / adaptive_grid / 4,
+                           (bounds[1] - bounds[3]) / adaptive_grid / 4,
+                           180 / adaptive_angles / 4),
+                          max_height, batch_size)
+
+
+def rasterize_region(region, bounds, cell_size):
+    '''
+    shapely.Polygon/MultiPolygon, tuple, float -> np.array(bool)
+
+    Rasterizes a region over the bounds (x_min, y_min, x_max, y_max) with square cells of cell_size.
+    Returns a (rows, columns) array that is True for the cells that are blocked (center outside the region),
+    grown by one cell in every direction so resampling the raster never makes a blocked cell look free.
+    '''
+    x_coords = np.arange(bounds[0] + cell_size / 2, bounds[2] + cell_size, cell_size)
+    y_coords = np.arange(bounds[1] + cell_size / 2, bounds[3] + cell_size, cell_size)
+    x_grid, y_grid = np.meshgrid(x_coords, y_coords)
+
+    # a cell is blocked if its center is not in the region
+    blocked = ~contains_xy(region, x_grid, y_grid)
+
+    # grow the blocked cells by one in every direction (the raster edge counts as blocked)
+    padded = np.pad(blocked, 1, constant_values=True)
+    grown = np.zeros_like(blocked)
+    for i in range(3):
+        for j in range(3):
+            grown |= padded[i:i + blocked.shape[0], j:j + blocked.shape[1]]
+
+    return grown
+
+
+def get_largest_window(blocked, aspect_ratio, max_rows):
+    '''
+    np.array(bool), float, int -> int, tuple
+
+    Finds the tallest window of k rows by ceil(aspect_ratio * k) columns with no blocked cells, using a summed-area
+    table so every window of a size is checked at once. A window that fits means any smaller one fits, so k is bisected.
+    Returns k (0 if no window fits) and the (row, column) of the window's first cell, picking the window nearest
+    the middle of all the windows of that size.
+    '''
+    # summed-area table of the blocked cells, with a row and column of zeros in front
+    table = np.zeros((blocked.shape[0] + 1, blocked.shape[1] + 1), dtype=np.int32)
+    table[1:, 1:] = blocked.cumsum(axis=0, dtype=np.int32).cumsum(axis=1, dtype=np.int32)
+
+    def free_windows(rows):
+        # number of blocked cells in every window of the size, zero where it fits
+        columns = max(1, math.ceil(aspect_ratio * rows))
+        if rows > blocked.shape[0] or columns > blocked.shape[1]:
+            return None
+        sums = table[rows:, columns:] - table[:-rows, columns:] - table[rows:, :-columns] + table[:-rows, :-columns]
+        return sums == 0
+
+    # bisect the number of rows between one that fits and one that doesn't
+    low, high = 0, min(max_rows, blocked.shape[0]) + 1
+    while high - low > 1:
+        mid = (low + high) // 2
+        windows = free_windows(mid)
+        if windows is not None and windows.any():
+            low = mid
+        else:
+            high = mid
+
+    if low == 0:
+        return 0, None
+
+    # of all the windows that fit, take the one nearest their middle
+    rows, columns = np.nonzero(free_windows(low))
+    nearest = np.argmin((rows - rows.mean()) ** 2 + (columns - columns.mean()) ** 2)
+
+    return low, (rows[nearest], columns[nearest])
+
+
+def raster_search(ply_polygon, ply_rosette, ply_markers, aspect_ratio, free_region, max_height, batch_size):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, float, shapely.Polygon, float, int -> list
+
+    Raster version of the nesting loop. Rasterizes the free region once with raster_resolution cells along its longer side,
+    then for each of angle_resolution angles resamples the raster into a grid rotated to that angle, where the rectangle
+    is axis aligned, and finds the largest window that fits with get_largest_window. The time per angle depends on
+    the raster size, not the number of candidates. The best window of each angle is then bisected exactly with the
+    polygon checks, and the best of those is verified with rect_check. If the search budget runs out the remaining
+    angles are skipped.
+    Returns a best_config [point, rect_height, angle], or None if no rectangle fits.
+    '''
+    if free_region.is_empty:
+        return None
+
+    # rasterize the free region shrunk by a cell, so no cell center can land in a gap too thin to see on the raster
+    # (e.g. the slits the rosette and marker lines cut into it)
+    x_min, y_min, x_max, y_max = free_region.bounds
+    cell_size = max(x_max - x_min, y_max - y_min) / raster_resolution
+    raster_region = free_region.buffer(-cell_size, join_style='mitre')
+    prepare(raster_region)
+    blocked = rasterize_region(raster_region, (x_min, y_min, x_max, y_max), cell_size)
+
+    # the rotated grids are centered on the region
+    center = np.array([(x_min + x_max) / 2, (y_min + y_max) / 2])
+    half_width, half_height = (x_max - x_min) / 2, (y_max - y_min) / 2
+
+    centers = []
+    angles = np.linspace(0, 180, angle_resolution, endpoint=False)
+    heights = []
+
+    for angle in angles:
+        # stop at the angles done so far once the budget runs out
+        if len(centers) > 0 and budget_expired():
+            count_stats(configs_planned=len(angles) - len(centers))
+            break
+
+        theta = math.radians(angle)
+        cos_t, sin_t = math.cos(theta), math.sin(theta)
+
+        # make the rotated grid just big enough to cover the region's bounding box at this angle
+        u_steps = np.arange(cell_size / 2, half_width * abs(cos_t) + half_height * abs(sin_t) + cell_size, cell_size)
+        v_steps = np.arange(cell_size / 2, half_width * abs(sin_t) + half_height * abs(cos_t) + cell_size, cell_size)
+        u_steps = np.concatenate([-u_steps[::-1], u_steps])
+        v_steps = np.concatenate([-v_steps[::-1], v_steps])
+
+        # find the base raster cell under each cell of the rotated grid (outside the raster is blocked)
+        column = np.floor((center[0] - x_min + u_steps[None, :] * cos_t - v_steps[:, None] * sin_t) / cell_size).astype(np.int32)
+        row = np.floor((center[1] - y_min + u_steps[None, :] * sin_t + v_steps[:, None] * cos_t) / cell_size).astype(np.int32)
+        inside = (row >= 0) & (row < blocked.shape[0]) & (column >= 0) & (column < blocked.shape[1])
+        rotated = np.ones(inside.shape, dtype=bool)
+        rotated[inside] = blocked[row[inside], column[inside]]
+
+        # find the largest window of the rectangle's aspect ratio
+        rows, first_cell = get_largest_window(rotated, aspect_ratio, int(max_height / cell_size) + 1)
+        if rows == 0:
+            centers.append(center)
+            heights.append(0)
+            continue
+
+        # convert the middle of the window back to the drawing
+        columns = max(1, math.ceil(aspect_ratio * rows))
+        u = u_steps[first_cell[1]] + (columns - 1) / 2 * cell_size
+        v = v_steps[first_cell[0]] + (rows - 1) / 2 * cell_size
+        centers.append(center + [u * cos_t - v * sin_t, u * sin_t + v * cos_t])
+        heights.append(rows * cell_size)
+
+    angles = angles[:len(centers)]
+    centers = np.array(centers)
+    heights = np.array(heights)
+    if not heights.any():
+        return None
 
-    # Unrotated rectangle corners centered at (0, 0)
-    half_w, half_h = w / 2, h / 2
-    corners = [
-        (-half_w, -half_h),
-        (half_w, -half_h),
-        (half_w, half_h),
-        (-half_w, half_h)
-    ]
+    # the raster is only accurate to a few cells, so bisect the height of the rectangle at each angle's window exactly,
+    # starting from the raster height where a rectangle of that height already fits
+    rotation_table = get_rotation_table(aspect_ratio, angles)
+    heights = np.clip(heights, min_rect_height, max_height)
+    fits = check_configs(ply_polygon, ply_rosette, ply_markers, rotation_table, centers, heights, np.arange(len(angles)),
+                         batch_size)
+    exact_heights = bisect_heights(ply_polygon, ply_rosette, ply_markers, rotation_table,
+                                   centers, np.arange(len(angles)), np.where(fits, heights, min_rect_height), max_height,
+                                   batch_size)
 
-    # Rotate and translate each corner
-    rotated_corners = []
-    for x, y in corners:
-        x_rot = x * math.cos(theta) - y * math.sin(theta)
-        y_rot = x * math.sin(theta) + y * math.cos(theta)
-        rotated_corners.append((x_rot + cx, y_rot + cy))
+    best = np.argmax(exact_heights)
+    if exact_heights[best] == 0:
+        return None
 
-    return Polygon(rotated_corners), rotated_corners
+    best_config = [centers[best], exact_heights[best], angles[best]]
+
+    # verify the chosen rectangle with the exact check
+    if not rect_check(ply_polygon, get_rotated_rectangle(aspect_ratio, *best_config)[0], ply_rosette, ply_markers):
+        return None
+
+    return best_config
 
 
 def delete_all_text(msp):
@@ -406,8 +1157,11 @@ def delete_all_text(msp):
 
     Delete all TEXT and MTEXT entities from a modelspace or layout.
     '''
-    for e in list(msp.query("TEXT MTEXT")):  # make a copy of list to avoid iteration issues
-        msp.delete_entity(e)
+    # deleting entities one by one searches the entity list for each of them, so destroy them all
+    # and then drop them from the layout in a single pass
+    for e in msp.query("TEXT MTEXT"):
+        e.destroy()
+    msp.purge()
 
 
 def draw_rectangle(msp, corners):
@@ -579,145 +1333,1629 @@ def save_files_from_dict(folder_path, file_contents_dict):
             print(f"Could not write file {filename}: {e}")
 
 
-#----SCRIPT----
+def search_placement(ply_polygon, ply_rosette, ply_markers, aspect_ratio, warm_config=None):
+    '''
+    shapely.Polygon, shapely.LineString, shapely.LineString, float, list -> list
 
-#----PARAMETER CONTROLS---- 
-# define the directory folder for ply dxfs
-file_path = '/Users/sheasmith/Documents/Plies_test'
+    Runs the placement search selected by search_mode and returns the best_config [point, rect_height, angle],
+    or None if no rectangle fits. If a warm_config from a similar ply is given and still fits, only its
+    neighbourhood is searched. With the rosette and markers None, ply_polygon is the free region from get_free_region.
+    The rectangle inscribed in the largest circle that fits is never beaten by a smaller label, so a search that
+    runs out of budget returns at least that.
+    '''
+    # bound the rectangle height and find seed points from the largest circle that fits in the free region
+    free_region = get_free_region(ply_polygon, ply_rosette, ply_markers)
+    max_height, seed_points, inscribed_config = get_height_bound(free_region, aspect_ratio)
+    set_quality(height_bound=float(max_height))
 
-# get the files
-uploaded = store_files_in_dict(file_path)
+    # the rectangle inscribed in that circle is a placement known to fit before any search
+    if inscribed_config is not None and (inscribed_config[1] < min_rect_height or not rect_check(
+            ply_polygon, get_rotated_rectangle(aspect_ratio, *inscribed_config)[0], ply_rosette, ply_markers)):
+        inscribed_config = None
 
-# set the current directory
-os.chdir(file_path)
+    #----NESTING LOOP----
+    best_config = None
+
+    if warm_config is not None:
+        # search around the placement of the similar ply
+        best_config = warm_start_search(ply_polygon,
+                                        ply_rosette,
+                                        ply_markers,
+                                        aspect_ratio,
+                                        warm_config,
+                                        get_bbox(ply_polygon),
+                                        max_height,
+                                        search_batch_size)
+
+    # otherwise run the selected search
+    if best_config is None:
+        if search_mode == 'raster':
+            # find the largest window of the rasterized free region at each angle
+            best_config = raster_search(ply_polygon,
+                                        ply_rosette,
+                                        ply_markers,
+                                        aspect_ratio,
+                                        free_region,
+                                        max_height,
+                                        search_batch_size)
+
+        elif search_mode == 'adaptive':
+            # search coarse-to-fine around the most promising configurations
+            best_config = adaptive_search(ply_polygon,
+                                          ply_rosette,
+                                          ply_markers,
+                                          aspect_ratio,
+                                          get_bbox(ply_polygon),
+                                          max_height,
+                                          search_batch_size,
+                                          seed_points,
+                                          free_region)
+
+    # if the exhaustive search is selected, or the adaptive coarse pass or raster search found nothing,
+    # try rectangles at the seed points and every point in the specified grid with a bunch of angles,
+    # bisecting their scale, keeping the largest rectangle that fits
+    if best_config is None:
+        if sample_inside:
+            # spend the num_x x num_y points on the inside of the free region
+            grid_points = np.concatenate([seed_points, get_sample_points(free_region, num_x * num_y)[0]])
+        else:
+            grid_points = np.concatenate([seed_points, get_grid(get_bbox(ply_polygon), num_x, num_y)])
+
+        # try the points with the most room around them first, so a search that runs out of budget has tried the best
+        grid_points = order_by_clearance(grid_points, free_region)
+
+        # each search thread takes a band of grid points and runs its own nesting loop
+        def band_search(index, polygon, rosette, markers):
+            return batch_search(polygon,
+                                rosette,
+                                markers,
+                                aspect_ratio,
+                                grid_points[index],
+                                np.linspace(0, 180, angle_resolution),
+                                max_height,
+                                search_batch_size)
+
+        band_configs = split_work(band_search, len(grid_points), search_threads, (ply_polygon, ply_rosette, ply_markers))
+
+        # keep the largest rectangle, the earliest band winning ties as in the nesting loop
+        for band_config in band_configs:
+            if band_config is not None and (best_config is None or band_config[1] > best_config[1]):
+                best_config = band_config
+
+    # a search cut short by its budget can end below the inscribed rectangle, which is known to fit
+    if inscribed_config is not None and (best_config is None or inscribed_config[1] > best_config[1]):
+        best_config = inscribed_config
+
+    return best_config
+
+
+def get_geometry_fingerprint(layer_vertices, aspect_ratio):
+    '''
+    dict, float -> str
 
-# number of test grid points along the x-axis of the ply bounding box
-num_x = 10
+    Hashes the vertices of the labelling layers together with the aspect ratio and every parameter that affects the
+    placement search, so two plies with the same fingerprint get the same best_config
+    '''
+    search_parameters = {name: globals()[name] for name in search_parameter_names}
 
-# number of test grid points along the y-axis of the ply bounding box
-num_y = 10
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps(layer_vertices, sort_keys=True).encode())
+    fingerprint.update(repr(float(aspect_ratio)).encode())
+    fingerprint.update(json.dumps(search_parameters, sort_keys=True).encode())
 
-# number of rectangle scale stages
-scale_resolution = 30
+    return fingerprint.hexdigest()
 
-# number of rectangle angle stages
-angle_resolution = 30
 
-# written on the first line of text on each ply
-line1_text = input("First line text (Digits following L will be replaced by ply number from filenames):")
+def open_placement_cache(cache_path):
+    '''
+    str -> sqlite3.Connection
 
-# ply prefix that will be used to find the ply number
-ply_prefix = input("ply prefix in filenames(e.g. 'L'):")
+    Opens (creating if needed) the on-disk placement cache, a SQLite table of fingerprint -> best_config
+    '''
+    # only imported when there is a cache, to keep the script quick to start
+    import sqlite3
 
-# written on the second line of text on each ply
-line2_text = input("Second line text:")
+    connection = sqlite3.connect(cache_path, timeout=60)
+    connection.execute('''CREATE TABLE IF NOT EXISTS placements
+                          (fingerprint TEXT PRIMARY KEY, best_config TEXT, last_used REAL)''')
 
-# padding between text fit rectangle and text
-padding = 0.5
+    return connection
 
-# linespacing
-line_space = 0.1
 
-# max text height
-max_text_height = 1
+def cache_get(connection, fingerprint):
+    '''
+    sqlite3.Connection, str -> list
 
-# character aspect ratio
-char_ratio = 0.77
+    Returns the cached best_config for a fingerprint (marking it as recently used), or None if it isn't cached
+    '''
+    row = connection.execute('SELECT best_config FROM placements WHERE fingerprint = ?', (fingerprint,)).fetchone()
+    if row is None:
+        return None
 
-# Tell the script which layer names are required to process a ply
-required_layers = ['OUTER', 'ROSETTE']
+    with connection:
+        connection.execute('UPDATE placements SET last_used = ? WHERE fingerprint = ?', (time.time(), fingerprint))
 
-# Tell the script how small to make curve slices
-slice_length = 1
+    x, y, rect_height, angle = json.loads(row[0])
 
-# Tell the script how many digits should be considered when comparing point locations
-round_digits = 6
+    return [np.array([x, y]), rect_height, angle]
 
-#----ITERATE OVER EACH FILE----
-# Grab each file from the upload by its filename
-for filename in uploaded.keys():
-    # define the dxf document and modelspace
-    doc = ezdxf.readfile(filename)
-    msp = doc.modelspace()
 
-    # ensure the file contains the specified layers
-    check_layers(msp, required_layers)
+def cache_put(connection, fingerprint, best_config):
+    '''
+    sqlite3.Connection, str, list -> None
 
-    # define the ply polygon in shapely (still works if INNER isn't present)
-    ply_polygon = Polygon(get_vertices(msp, 'OUTER'), get_vertices(msp, 'INNER'))
+    Stores a best_config in the cache, evicting the least recently used entries beyond cache_size
+    '''
+    point, rect_height, angle = best_config
+    value = json.dumps([float(point[0]), float(point[1]), float(rect_height), float(angle)])
 
-    # define the ply rosette in shapely
-    ply_rosette = LineString(get_vertices(msp, 'ROSETTE'))
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO placements VALUES (?, ?, ?)', (fingerprint, value, time.time()))
+        connection.execute('''DELETE FROM placements WHERE fingerprint NOT IN
+                              (SELECT fingerprint FROM placements ORDER BY last_used DESC LIMIT ?)''', (cache_size,))
 
-    # define the ply markers in shapely (if they aren't present, still run this step)
-    ply_markers = LineString(get_vertices(msp, 'MARKERS'))
 
-    # define the line1 and line2 text
-    this_line1_text = line1_text + get_ply_number(filename, ply_prefix)
-    this_line2_text = line2_text
+def reset_stats():
+    '''
+    None -> None
 
-    # based on the text, find the aspect ratio of the fitting rectangle
-    aspect_ratio_to_use = get_aspect_ratio(this_line1_text, this_line2_text, line_space, padding)
+    Clears the stage timings, counters and search quality collected for the current ply
+    '''
+    global stats
+    stats = {'timings': {}, 'counters': {}, 'quality': {}}
 
-    #----NESTING LOOP----
-    running_max = 0
-    # for every point in the specified grid...
-    for point in get_grid(get_bbox(ply_polygon),
-                          num_x,
-                          num_y):
-        #...try rectangles with a bunch of scales...
-        for rect_height in np.linspace(0.51,
-                                       math.sqrt(ply_polygon.area),
-                                       scale_resolution):
-            #...and a bunch of angles...
-            for angle in np.linspace(0,
-                                     180,
-                                     angle_resolution):
-                # if the rectangle fits and is larger than previous largest option,
-                # make it the new largest option
-                if rect_check(ply_polygon,
-                              get_rotated_rectangle(aspect_ratio_to_use,
-                                                    tuple(point),
-                                                    rect_height,
-                                                    angle)[0],
-                              ply_rosette,
-                              ply_markers
-                              ) and rect_height > running_max:
-                    running_max = rect_height
-                    best_config = [point,
-                                   rect_height,
-                                   angle]
-                    continue
 
-    # remove all text from the file
-    delete_all_text(msp)
+def count_stats(**counts):
+    '''
+    int -> None
+
+    Adds to the named counters of the current ply (safe to call from search threads)
+    '''
+    with stats_lock:
+        for name, count in counts.items():
+            stats['counters'][name] = stats['counters'].get(name, 0) + count
 
-    # optionally, draw the fitting rectangle on the dxf for debugging use
-    # draw_rectangle(msp, get_rotated_rectangle(aspect_ratio_to_use, best_config[0], best_config[1], best_config[2])[1])
 
-    # make the text as specified by the nesting loop unless its larger than 1 inch
-    if scale_text(best_config[1], padding, line_space) > 1:
-        # if fitting rectangle can accomodate text larger than 1 inch, make the text 1 inch and put it at centroid
-        text_height = 1
-    else:
-        text_height = scale_text(best_config[1], padding, line_space)
-
-    # place the text
-    place_first_line_text(msp,
-                          best_config[0],
-                          best_config[2],
-                          text_height,
-                          line_space,
-                          text=this_line1_text)
-
-    place_second_line_text(msp,
-                           best_config[0],
-                           best_config[2],
-                           text_height,
-                           line_space,
-                           text=this_line2_text)
-
-    # save the file
-    doc.saveas(filename)
-
-print('DONE.')
+def set_quality(**values):
+    '''
+    float/bool -> None
+
+    Sets the named search quality values of the current ply (safe to call from search threads)
+    '''
+    with stats_lock:
+        stats['quality'].update(values)
+
+
+def start_search_budget():
+    '''
+    None -> None
+
+    Starts the search budget of a ply: search_time_limit seconds and search_check_limit rectangle checks from now.
+    The counters are remembered so the checks and coverage of this search alone can be worked out
+    '''
+    with stats_lock:
+        search_budget['counters'] = dict(stats['counters'])
+    search_budget['deadline'] = None if search_time_limit is None else time.perf_counter() + search_time_limit
+    search_budget['expired'] = False
+
+
+def get_search_count(name):
+    '''
+    str -> int
+
+    Returns how much the named counter has gone up since the search budget was started
+    '''
+    return stats['counters'].get(name, 0) - search_budget['counters'].get(name, 0)
+
+
+def budget_expired():
+    '''
+    None -> bool
+
+    Returns True once the search of the current ply has run past its search_time_limit or search_check_limit.
+    The searches check it between rounds and return the best configuration found so far when it has run out
+    '''
+    with stats_lock:
+        expired = not search_budget['expired'] and (
+            (search_budget['deadline'] is not None and time.perf_counter() >= search_budget['deadline'])
+            or (search_check_limit is not None and get_search_count('rectangles_checked') >= search_check_limit))
+        if expired:
+            search_budget['expired'] = True
+
+    # count the plies whose search was cut short
+    if expired:
+        count_stats(budget_expired=1)
+
+    return search_budget['expired']
+
+
+@contextmanager
+def timed(stage):
+    '''
+    str -> context manager
+
+    Adds the time spent inside a with block to the named stage timing of the current ply
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with stats_lock:
+            stats['timings'][stage] = stats['timings'].get(stage, 0) + time.perf_counter() - start
+
+
+def find_placement(layer_vertices, line1_text, line2_text, warm_config=None):
+    '''
+    dict, str, str, list -> list, bool
+
+    Finds the largest rectangle for the two lines of text that fits in a ply, given the get_layer_vertices
+    of its OUTER, INNER, ROSETTE and MARKERS layers. Returns the best_config and whether it came from the placement cache.
+    A warm_config from a similar ply is tried first (see search_placement).
+
+    The search stops at the best configuration found so far after search_time_limit seconds or search_check_limit
+    rectangle checks. The quality of the search is kept in the stats: the fraction of the planned configurations
+    that were searched (coverage), the achieved height against the upper bound on it, and whether the budget ran out.
+
+    Raises an exception if:
+      - no rectangle fits in the ply
+    '''
+    with timed('vertices'):
+        # define the ply polygon in shapely (still works if INNER isn't present)
+        ply_polygon = Polygon(layer_vertices['OUTER'], layer_vertices['INNER'])
+
+        # define the ply rosette in shapely
+        ply_rosette = get_line_geometry(layer_vertices['ROSETTE'])
+
+        # define the ply markers in shapely (if they aren't present, still run this step)
+        ply_markers = get_line_geometry(layer_vertices['MARKERS'])
+
+        # shrink and simplify the polygon for the search
+        search_polygon = get_search_polygon(ply_polygon)
+
+        # cut the rosette and markers out of it once, with the clearance margin, so each candidate rectangle
+        # needs a single containment check against the prepared region
+        free_region = get_free_region(search_polygon, ply_rosette, ply_markers)
+        prepare(free_region)
+
+    count_stats(polygon_vertices=len(get_coordinates(ply_polygon)),
+                search_vertices=len(get_coordinates(free_region)),
+                obstacle_vertices=len(get_coordinates(ply_rosette)) + len(get_coordinates(ply_markers)))
+
+    # based on the text, find the aspect ratio of the fitting rectangle
+    aspect_ratio_to_use = get_aspect_ratio(line1_text, line2_text, line_space, padding)
+
+    # look for a placement of the same geometry and text size from a previous run or an earlier ply
+    best_config = None
+    if cache_path is not None:
+        with timed('cache'):
+            fingerprint = get_geometry_fingerprint(layer_vertices, aspect_ratio_to_use)
+            with closing(open_placement_cache(cache_path)) as cache:
+                best_config = cache_get(cache, fingerprint)
+    cached = best_config is not None
+
+    # otherwise find the largest rectangle that fits
+    if best_config is None:
+        with timed('search'):
+            start_search_budget()
+
+            best_config = search_placement(free_region, None, None, aspect_ratio_to_use, warm_config=warm_config)
+
+            # the search polygon is inside the ply, but check the rectangle against the free region of the full polygon
+            # anyway, and search that region if it doesn't fit or nothing fit the shrunk polygon (e.g. a narrow strip)
+            if search_polygon is not ply_polygon:
+                full_region = get_free_region(ply_polygon, ply_rosette, ply_markers)
+                prepare(full_region)
+
+                if (best_config is None
+                        or not rect_check(full_region, get_rotated_rectangle(aspect_ratio_to_use, *best_config)[0], None, None)):
+                    best_config = search_placement(full_region, None, None, aspect_ratio_to_use, warm_config=warm_config)
+
+            # report how much of the search was done and how close the label is to the largest that could fit
+            height = 0.0 if best_config is None else float(best_config[1])
+            height_bound = stats['quality'].get('height_bound', 0)
+            set_quality(coverage=get_search_count('configs_searched') / max(get_search_count('configs_planned'), 1),
+                        height=height,
+                        height_ratio=height / height_bound if height_bound > 0 else 0.0,
+                        budget_expired=search_budget['expired'])
+
+        # keep it for next time (the cache isn't held open during the search),
+        # unless the search was cut short and a full one could find a better placement
+        if cache_path is not None and best_config is not None and not search_budget['expired']:
+            with timed('cache'):
+                with closing(open_placement_cache(cache_path)) as cache:
+                    cache_put(cache, fingerprint, best_config)
+
+    if best_config is None:
+        raise Exception('No label placement found')
+
+    return best_config, cached
+
+
+def get_placement(best_config, line1_text, line2_text):
+    '''
+    list, str, str -> dict
+
+    Describes where the two lines of text go in plain JSON types: the center, angle (degrees), height and width
+    of the fitting rectangle found by the search, its corners, the text height and the two lines of text
+    '''
+    point, rect_height, angle = best_config
+    aspect_ratio = get_aspect_ratio(line1_text, line2_text, line_space, padding)
+
+    # corners of the fitting rectangle, for reviewing placements without opening the dxf
+    corners = get_rotated_rectangle(aspect_ratio, point, rect_height, angle)[1]
+
+    return {'center': [float(point[0]), float(point[1])],
+            'angle': float(angle),
+            'rect_height': float(rect_height),
+            'rect_width': float(rect_height * aspect_ratio),
+            'corners': [[float(x), float(y)] for x, y in corners],
+            # make the text as specified by the nesting loop unless its larger than max_text_height
+            'text_height': float(min(scale_text(rect_height, padding, line_space), max_text_height)),
+            'line1': line1_text,
+            'line2': line2_text}
+
+
+def refit_placement(placement, line1_text, line2_text):
+    '''
+    dict, str, str -> dict
+
+    Puts new lines of text in the fitting rectangle of a placement without searching again.
+    Text that needs a wider rectangle than the one found is made smaller to fit in it.
+    '''
+    placement = dict(placement)
+    placement['line1'] = line1_text
+    placement['line2'] = line2_text
+
+    # tallest rectangle of the new text's aspect ratio that fits in the found one
+    aspect_ratio = get_aspect_ratio(line1_text, line2_text, line_space, padding)
+    rect_height = min(placement['rect_height'], placement['rect_width'] / aspect_ratio)
+
+    placement['text_height'] = float(min(scale_text(rect_height, padding, line_space), max_text_height))
+
+    return placement
+
+
+def write_placement(msp, placement):
+    '''
+    ezdxf.layouts.layout.Modelspace, dict -> None
+
+    Replaces all the text in the modelspace with the two lines of text of a placement (see get_placement)
+    '''
+    with timed('text'):
+        # remove all text from the file
+        delete_all_text(msp)
+
+        # optionally, draw the fitting rectangle on the dxf for debugging use
+        # draw_rectangle(msp, placement['corners'])
+
+        # place the text
+        place_first_line_text(msp,
+                              placement['center'],
+                              placement['angle'],
+                              placement['text_height'],
+                              line_space,
+                              text=placement['line1'])
+
+        place_second_line_text(msp,
+                               placement['center'],
+                               placement['angle'],
+                               placement['text_height'],
+                               line_space,
+                               text=placement['line2'])
+
+
+def write_label(msp, best_config, line1_text, line2_text):
+    '''
+    ezdxf.layouts.layout.Modelspace, list, str, str -> None
+
+    Replaces all the text in the modelspace with the two lines of text, placed and sized by the best_config
+    '''
+    write_placement(msp, get_placement(best_config, line1_text, line2_text))
+
+
+def save_doc(doc, file_path):
+    '''
+    ezdxf.document.Drawing, str -> None
+
+    Saves a document over file_path by writing it next to it and then swapping it in, so a process that is killed
+    while saving leaves either the old file or the new one and never half of one
+    '''
+    temp_path = file_path + '.tmp'
+
+    try:
+        doc.saveas(temp_path)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def read_ply_vertices(msp):
+    '''
+    ezdxf.layouts.layout.Modelspace -> dict
+
+    Checks the modelspace has the required layers and reads the vertices of all the labelling layers in one pass over it
+    '''
+    with timed('vertices'):
+        # ensure the file contains the specified layers
+        check_layers(msp, required_layers)
+
+        # read the vertices of all the layers in one pass over the modelspace
+        return get_layer_vertices(msp, ['OUTER', 'INNER', 'ROSETTE', 'MARKERS'])
+
+
+def label_ply(doc, line1_text, line2_text, config=None, warm_config=None):
+    '''
+    ezdxf.document.Drawing, str, str, dict, list -> dict
+
+    Finds the best text placement in an open ply DXF document and replaces its text with the two lines of text.
+    The document is changed in memory but not saved. config can override any of the PARAMETER CONTROLS values for this call,
+    and the search starts from the warm_config (e.g. the best_config of the previous ply) if it still fits.
+
+    Returns a dict with the best_config and whether it came from the placement cache
+
+    Raises an exception if:
+      - a required layer is not found
+      - no rectangle fits in the ply
+    '''
+    with use_parameters(config):
+        msp = doc.modelspace()
+
+        layer_vertices = read_ply_vertices(msp)
+
+        # find the largest rectangle that fits
+        best_config, cached = find_placement(layer_vertices, line1_text, line2_text, warm_config)
+
+        # and write the text in it
+        write_label(msp, best_config, line1_text, line2_text)
+
+    return {'best_config': best_config, 'cached': cached}
+
+
+def process_file(file_path, line1_text, line2_text, ply_prefix, warm_config=None, compute_only=False):
+    '''
+    str, str, str, str, list, bool -> dict
+
+    Labels one ply DXF in place: reads it, finds the best text placement, writes the two lines of text and saves it.
+    The ply number found after ply_prefix in the filename is added to the end of line1_text.
+    Any error is caught and returned in the result so one bad file doesn't stop a batch.
+    The search starts from the warm_config (e.g. the best_config of the previous ply) if it still fits.
+    With compute_only the placement is found but the file is left as it is (to be labelled later by apply_placements).
+
+    Returns a dict with the filename, its status ('done' or 'failed'), the error message, the best_config,
+    the placement (see get_placement), whether it came from the placement cache, and the stage timings (seconds)
+    and counters of the ply. If profile_path is set, a cProfile of the file is saved in that folder as <filename>.prof
+    '''
+    filename = os.path.basename(file_path)
+    result = {'filename': filename, 'status': 'failed', 'error': None, 'best_config': None, 'placement': None, 'cached': False}
+
+    reset_stats()
+
+    profiler = None
+    if profile_path is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        # label the ply with its ply number on the first line
+        line1_text = line1_text + get_ply_number(filename, ply_prefix)
+
+        # the whole document isn't needed when only the placement is
+        if (stream_read or compute_only) and not is_binary_dxf_file(file_path):
+            # stream only the labelling layers out of the file to find the placement
+            with timed('stream'):
+                layer_list, entities = read_layer_entities(file_path, ['OUTER', 'INNER', 'ROSETTE', 'MARKERS'])
+
+            with timed('vertices'):
+                # ensure the file contains the specified layers
+                check_layer_list(layer_list, required_layers)
+
+                # read the vertices of all the layers
+                layer_vertices = get_layer_vertices(entities, ['OUTER', 'INNER', 'ROSETTE', 'MARKERS'])
+
+            result['best_config'], result['cached'] = find_placement(layer_vertices, line1_text, line2_text, warm_config)
+
+            if not compute_only:
+                # then load the whole document only to write the text
+                with timed('read'):
+                    doc = ezdxf.readfile(file_path)
+
+                write_label(doc.modelspace(), result['best_config'], line1_text, line2_text)
+
+        else:
+            # define the dxf document
+            with timed('read'):
+                doc = ezdxf.readfile(file_path)
+
+            if compute_only:
+                result['best_config'], result['cached'] = find_placement(read_ply_vertices(doc.modelspace()),
+                                                                         line1_text, line2_text, warm_config)
+            else:
+                result.update(label_ply(doc, line1_text, line2_text, warm_config=warm_config))
+
+        result['placement'] = get_placement(result['best_config'], line1_text, line2_text)
+
+        # save the file
+        if not compute_only:
+            with timed('write'):
+                save_doc(doc, file_path)
+
+        result['status'] = 'done'
+
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(profile_path, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_path, filename + '.prof'))
+
+    result.update(stats)
+
+    return result
+
+
+def get_empty_result(filename, status, error=None):
+    '''
+    str, str, str -> dict
+
+    Makes the result of a file that process_file did not report on, e.g. one that failed because its worker
+    process died, or one that was skipped because it was already labelled
+    '''
+    return {'filename': filename,
+            'status': status,
+            'error': error,
+            'best_config': None,
+            'placement': None,
+            'cached': False,
+            'timings': {},
+            'counters': {},
+            'quality': {}}
+
+
+def set_parameters(parameters):
+    '''
+    dict -> None
+
+    Overrides PARAMETER CONTROLS values in this module (used to set up worker processes)
+
+    Raises an exception if:
+      - a parameter name is not one of parameter_names
+    '''
+    for name in parameters:
+        if name not in parameter_names:
+            raise ValueError(f'Unknown parameter {name}')
+
+    globals().update(parameters)
+
+
+@contextmanager
+def use_parameters(config):
+    '''
+    dict -> context manager
+
+    Overrides PARAMETER CONTROLS values inside a with block and restores them afterwards.
+    The values are module wide, so calls with different configs should not run in threads at the same time.
+    '''
+    if not config:
+        yield
+        return
+
+    previous = {name: globals()[name] for name in config if name in parameter_names}
+    set_parameters(config)
+
+    try:
+        yield
+    finally:
+        globals().update(previous)
+
+
+def iter_with_parameters(config, results):
+    '''
+    dict, generator -> generator
+
+    Yields the items of a generator, overriding PARAMETER CONTROLS values with config only while it works out each one
+    (see use_parameters). The values are restored before every item is handed back, so the caller's loop sees its own
+    values, and nothing is left overridden if the loop stops early.
+    '''
+    try:
+        while True:
+            with use_parameters(config):
+                try:
+                    result = next(results)
+                except StopIteration:
+                    return
+
+            yield result
+    finally:
+        # let the generator clean up (e.g. shut down its worker processes) with the values it ran with
+        with use_parameters(config):
+            results.close()
+
+
+def sort_by_ply_number(file_paths, ply_prefix):
+    '''
+    iterable(str), str -> list(str)
+
+    Orders file paths by the ply number in their filenames, so consecutive plies of a stack follow each other.
+    Files without a ply number go last, in name order.
+    '''
+    def ply_order(file_path):
+        filename = os.path.basename(file_path)
+        match = re.search(fr"{re.escape(ply_prefix)}(\d+)", filename)
+        return (0, int(match.group(1)), filename) if match else (1, 0, filename)
+
+    return sorted(file_paths, key=ply_order)
+
+
+def hash_file(file_path):
+    '''
+    str -> str
+
+    Returns the SHA-256 hash of a file's contents
+    '''
+    file_hash = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def get_batch_fingerprint(line1_text, line2_text, ply_prefix, compute_only):
+    '''
+    str, str, str, bool -> str
+
+    Hashes the text, ply prefix, mode and every parameter that changes the labels of a batch, so a journal
+    only counts files as done when they were labelled the same way
+    '''
+    label_parameters = {name: globals()[name] for name in search_parameter_names
+                        + ['search_time_limit', 'search_check_limit', 'padding', 'line_space', 'max_text_height',
+                           'char_ratio', 'required_layers']}
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps([line1_text, line2_text, ply_prefix, compute_only]).encode())
+    fingerprint.update(json.dumps(label_parameters, sort_keys=True).encode())
+
+    return fingerprint.hexdigest()
+
+
+def read_journal(journal_path):
+    '''
+    str -> dict
+
+    Reads a batch journal, returning the last record of every file in it by filename (an empty dict if there is
+    no journal yet). A line cut short by a process that was killed while writing it is ignored.
+    '''
+    journal = {}
+    if not os.path.exists(journal_path):
+        return journal
+
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            journal[record['filename']] = record
+
+    return journal
+
+
+def journal_files(file_paths, journal_path, batch, process):
+    '''
+    iterable(str), str, str, function -> generator(dict)
+
+    Runs process (a function from an iterable of file paths to a generator of results, e.g. process_files)
+    on the files that a journal doesn't record as done, yielding every result. A file is skipped, with a result
+    of status 'skipped', if its last record is done for the same batch fingerprint (see get_batch_fingerprint)
+    and its contents still hash to the output of that record. Everything else, including failures, files that
+    changed since and files that were being labelled when a batch died, is processed again.
+
+    A record is appended to the journal as each file finishes: the filename, batch fingerprint, status, error,
+    hashes of the file before and after, placement, seconds spent and the time it finished.
+    '''
+    journal = read_journal(journal_path)
+    input_hashes = {}
+    paths = {}
+    skipped = deque()
+
+    def unfinished():
+        for file_path in file_paths:
+            filename = os.path.basename(file_path)
+            record = journal.get(filename)
+            paths[filename] = file_path
+
+            # hash the file as it is before it is labelled (a missing file is left for process to report)
+            input_hashes[filename] = hash_file(file_path) if os.path.exists(file_path) else None
+
+            if (record is not None and record['status'] == 'done' and record['batch'] == batch
+                    and record['output_hash'] == input_hashes[filename]):
+                # keep the placement found, so a placements file still lists every file
+                result = get_empty_result(filename, 'skipped')
+                result['placement'] = record.get('placement')
+                skipped.append(result)
+            else:
+                yield file_path
+
+    # end a line cut short by a killed process, so the next record starts on a line of its own
+    cut_short = False
+    if os.path.exists(journal_path) and os.path.getsize(journal_path) != 0:
+        with open(journal_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            cut_short = f.read() != b'\n'
+
+    with open(journal_path, 'a') as journal_file:
+        if cut_short:
+            journal_file.write('\n')
+
+        for result in process(unfinished()):
+            # report the files skipped on the way to this one
+            while skipped:
+                yield skipped.popleft()
+
+            # hash the file as it was left
+            filename = result['filename']
+            output_hash = None
+            if result['status'] == 'done':
+                output_hash = hash_file(paths[filename])
+
+            journal_file.write(json.dumps({'filename': filename,
+                                           'batch': batch,
+                                           'status': result['status'],
+                                           'error': result['error'],
+                                           'input_hash': input_hashes.get(filename),
+                                           'output_hash': output_hash,
+                                           'placement': result['placement'],
+                                           'seconds': sum(result['timings'].values()),
+                                           'finished': time.time()}) + '\n')
+            journal_file.flush()
+
+            yield result
+
+        while skipped:
+            yield skipped.popleft()
+
+
+def start_pool(jobs, mp_context=None):
+    '''
+    int, multiprocessing context -> dict
+
+    Starts a pool of jobs worker processes (from mp_context, or the default start method if it is None), handing them
+    the current PARAMETER CONTROLS values since they may re-import this module. Returns a dict of the executor and
+    what is needed to start it again (see restart_pool) or to start a process like its workers (see submit_isolated).
+    '''
+    pool = {'jobs': jobs,
+            'mp_context': mp_context,
+            'parameters': {name: globals()[name] for name in parameter_names}}
+    pool['executor'] = ProcessPoolExecutor(max_workers=jobs, mp_context=mp_context,
+                                           initializer=set_parameters, initargs=(pool['parameters'],))
+
+    return pool
+
+
+def restart_pool(pool, executor):
+    '''
+    dict, ProcessPoolExecutor -> None
+
+    Replaces executor, which broke when one of its worker processes died, with a new one in the pool.
+    Nothing is done if the pool has already moved on from executor, so every file that saw it break can call this.
+    '''
+    if pool['executor'] is not executor:
+        return
+
+    executor.shutdown(wait=False)
+    pool['executor'] = ProcessPoolExecutor(max_workers=pool['jobs'], mp_context=pool['mp_context'],
+                                           initializer=set_parameters, initargs=(pool['parameters'],))
+
+
+def submit_isolated(pool, function, *args):
+    '''
+    dict, function, ... -> concurrent.futures.Future
+
+    Runs function(*args) in a worker process of its own, set up like the workers of the pool.
+    When a pool breaks there is no telling which of its files killed the worker, so the files it didn't finish are
+    run again this way: the one whose own process dies (its future raises BrokenProcessPool) is the one that broke
+    the pool, and nothing else goes down with it.
+    '''
+    executor = ProcessPoolExecutor(max_workers=1, mp_context=pool['mp_context'],
+                                   initializer=set_parameters, initargs=(pool['parameters'],))
+    future = executor.submit(function, *args)
+
+    # the process exits once its file is done
+    executor.shutdown(wait=False)
+
+    return future
+
+
+def process_files(file_paths, line1_text, line2_text, ply_prefix, jobs=1, compute_only=False):
+    '''
+    iterable(str), str, str, str, int, bool -> generator(dict)
+
+    Labels every file with process_file (or only finds its placement with compute_only), yielding each result
+    in the same order as file_paths.
+    With jobs > 1 the files are fanned out to a pool of worker processes. file_paths is consumed lazily
+    and only a few files per worker are in flight at once, so memory doesn't grow with the size of the batch.
+    If a worker process dies, only the file it was labelling fails: the pool is started again and the other
+    files it hadn't finished are run again (see submit_isolated).
+    With warm_start the files are labelled in ply number order, each search starting from the placement of the
+    ply before it (only when jobs is 1, since the plies have to be labelled one after another).
+    '''
+    if warm_start:
+        file_paths = sort_by_ply_number(file_paths, ply_prefix)
+
+    # label one file after another
+    if jobs <= 1:
+        warm_config = None
+        for file_path in file_paths:
+            result = process_file(file_path, line1_text, line2_text, ply_prefix, warm_config, compute_only)
+
+            # start the next ply from this one
+            if warm_start and result['status'] == 'done':
+                warm_config = result['best_config']
+
+            yield result
+        return
+
+    pool = start_pool(jobs)
+    pending = deque()
+    file_paths = iter(file_paths)
+
+    def restart():
+        # the broken pool fails every file it hadn't finished, so run those again each in a process of its own
+        restart_pool(pool, pool['executor'])
+        for entry in pending:
+            if not entry['isolated'] and isinstance(entry['future'].exception(), BrokenProcessPool):
+                entry['future'] = submit_isolated(pool, process_file, entry['file_path'], line1_text, line2_text,
+                                                  ply_prefix, None, compute_only)
+                entry['isolated'] = True
+
+    try:
+        while True:
+            # keep every worker busy with a couple of files queued up
+            for file_path in file_paths:
+                args = (process_file, file_path, line1_text, line2_text, ply_prefix, None, compute_only)
+                try:
+                    future = pool['executor'].submit(*args)
+                except BrokenProcessPool:
+                    # the pool broke before this file got into it
+                    restart()
+                    future = pool['executor'].submit(*args)
+
+                pending.append({'file_path': file_path, 'future': future, 'isolated': False})
+                if len(pending) >= 2 * jobs:
+                    break
+
+            if len(pending) == 0:
+                break
+
+            entry = pending[0]
+            try:
+                result = entry['future'].result()
+            except BrokenProcessPool as e:
+                # a file that was in the pool when it broke, so wait for its run in a process of its own
+                if not entry['isolated']:
+                    restart()
+                    continue
+
+                # the file killed its own worker process
+                result = get_empty_result(os.path.basename(entry['file_path']), 'failed', f'{type(e).__name__}: {e}')
+            except Exception as e:
+                result = get_empty_result(os.path.basename(entry['file_path']), 'failed', f'{type(e).__name__}: {e}')
+
+            pending.popleft()
+            yield result
+    finally:
+        pool['executor'].shutdown()
+
+
+def label_folder(folder_path, line1_text, line2_text, ply_prefix, config=None, jobs=1, compute_only=False, journal_path=None):
+    '''
+    str, str, str, str, dict, int, bool, str -> generator(dict)
+
+    Labels every DXF in a folder in place, yielding the process_file result of each file as it is done.
+    config can override any of the PARAMETER CONTROLS values, and jobs sets the number of worker processes.
+    With compute_only the placements are found but the files are left as they are.
+    With a journal_path the batch is journaled there and files it records as done are skipped (see journal_files),
+    so a batch that died partway can be run again to finish it.
+    '''
+    def label_files():
+        file_paths = iter_dxf_files(folder_path)
+
+        if journal_path is None:
+            yield from process_files(file_paths, line1_text, line2_text, ply_prefix, jobs, compute_only)
+        else:
+            yield from journal_files(file_paths,
+                                     journal_path,
+                                     get_batch_fingerprint(line1_text, line2_text, ply_prefix, compute_only),
+                                     lambda file_paths: process_files(file_paths, line1_text, line2_text, ply_prefix,
+                                                                      jobs, compute_only))
+
+    # the config only applies while each file is labelled, not in the caller's loop
+    yield from iter_with_parameters(config, label_files())
+
+
+def get_placement_line(result):
+    '''
+    dict -> str
+
+    Formats a process_file result as one JSON line for a placements file: the filename, status and error
+    followed by the placement fields (see get_placement)
+    '''
+    record = {'filename': result['filename'], 'status': result['status'], 'error': result['error']}
+
+    if result['placement'] is not None:
+        record.update(result['placement'])
+
+    return json.dumps(record)
+
+
+def read_placements(placements_path):
+    '''
+    str -> dict
+
+    Reads a placements file written from get_placement_line, returning its records by filename
+    (a file listed more than once keeps its last record)
+    '''
+    placements = {}
+
+    with open(placements_path) as f:
+        for line in f:
+            # skip blank lines
+            if line.strip() == '':
+                continue
+
+            record = json.loads(line)
+            placements[record['filename']] = record
+
+    return placements
+
+
+def apply_placement(file_path, placement):
+    '''
+    str, dict -> dict
+
+    Labels one ply DXF in place from an already found placement, without searching: reads it,
+    writes the two lines of text of the placement and saves it. Any error is caught and returned in the result.
+
+    Returns a dict with the filename, its status ('done' or 'failed'), the error message, the placement
+    and the stage timings (seconds) and counters of the ply
+    '''
+    result = {'filename': os.path.basename(file_path), 'status': 'failed', 'error': None, 'placement': placement}
+
+    reset_stats()
+
+    try:
+        with timed('read'):
+            doc = ezdxf.readfile(file_path)
+
+        write_placement(doc.modelspace(), placement)
+
+        with timed('write'):
+            save_doc(doc, file_path)
+
+        result['status'] = 'done'
+
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+
+    result.update(stats)
+
+    return result
+
+
+def apply_placements(folder_path, placements_path, line1_text=None, line2_text=None, ply_prefix=None, config=None):
+    '''
+    str, str, str, str, str, dict -> generator(dict)
+
+    Labels every file listed in a placements file from the folder in place, yielding the apply_placement result
+    of each file as it is done. Files whose placement could not be found are reported as failed.
+    New line1_text (with the ply number after ply_prefix added to its end) or line2_text replace the text of
+    the placements, made smaller where needed to fit in the rectangles already found (see refit_placement).
+    config can override any of the PARAMETER CONTROLS values.
+    '''
+    def apply_files():
+        for filename, record in read_placements(placements_path).items():
+            if 'center' not in record:
+                yield get_empty_result(filename, 'failed', f"no placement: {record['error']}")
+                continue
+
+            placement = {key: record[key] for key in ['center', 'angle', 'rect_height', 'rect_width', 'corners',
+                                                      'text_height', 'line1', 'line2']}
+
+            # put any new text in the rectangle that was found for the old text
+            if line1_text is not None or line2_text is not None:
+                try:
+                    placement = refit_placement(placement,
+                                                placement['line1'] if line1_text is None
+                                                else line1_text + get_ply_number(filename, ply_prefix),
+                                                placement['line2'] if line2_text is None else line2_text)
+                except Exception as e:
+                    yield get_empty_result(filename, 'failed', f'{type(e).__name__}: {e}')
+                    continue
+
+            yield apply_placement(os.path.join(folder_path, filename), placement)
+
+    # the config only applies while each file is labelled, not in the caller's loop
+    yield from iter_with_parameters(config, apply_files())
+
+
+def get_report_record(result):
+    '''
+    dict -> dict
+
+    Converts a process_file (or apply_placement) result to JSON types for the run report, with the best_config
+    written as [x, y, rect_height, angle] and the total time of the file
+    '''
+    record = dict(result)
+
+    if result.get('best_config') is not None:
+        point, rect_height, angle = result['best_config']
+        record['best_config'] = [float(point[0]), float(point[1]), float(rect_height), float(angle)]
+
+    record['seconds'] = sum(result['timings'].values())
+
+    return record
+
+
+def get_report_line(result):
+    '''
+    dict -> str
+
+    Formats a process_file (or apply_placement) result as one JSON line for the run report (see get_report_record)
+    '''
+    return json.dumps(get_report_record(result))
+
+
+def run_job_file(parameters, file_path, line1_text, line2_text, ply_prefix, warm_config=None, compute_only=False):
+    '''
+    dict, str, str, str, str, list, bool -> dict
+
+    Runs process_file with the PARAMETER CONTROLS values of a worker job (used in the worker processes of serve_jobs)
+    '''
+    with use_parameters(parameters):
+        return process_file(file_path, line1_text, line2_text, ply_prefix, warm_config, compute_only)
+
+
+def parse_job(job):
+    '''
+    dict -> dict
+
+    Checks a worker job read from a JSON line and returns it with its list of file paths and the PARAMETER CONTROLS
+    values to run it with (the worker's own values, overridden by the job's config). A job looks like
+    {"id": 7, "folder": "/path/to/plies", "line1": "L", "line2": "JOB", "ply_prefix": "L", "config": {...}, "placements": false}
+    with "file" or a list of "files" instead of "folder" to label only those files, and "placements" true to only
+    find the placements and leave the files as they are. "id", "config" and "placements" are optional.
+
+    Raises an exception if:
+      - the job is not a JSON object
+      - the job has no folder, file or files, or no line1, line2 or ply_prefix
+      - the folder does not exist
+      - a config name is not one of parameter_names
+    '''
+    if not isinstance(job, dict):
+        raise ValueError('a job must be a JSON object')
+
+    for key in ['line1', 'line2', 'ply_prefix']:
+        if not isinstance(job.get(key), str):
+            raise ValueError(f'job has no {key}')
+
+    # the files to label
+    if 'folder' in job:
+        if not isinstance(job['folder'], str) or not os.path.isdir(job['folder']):
+            raise ValueError(f"the folder at {job['folder']!r} does not exist")
+        job['file_paths'] = list(iter_dxf_files(job['folder']))
+    elif 'files' in job:
+        job['file_paths'] = list(job['files'])
+    elif 'file' in job:
+        job['file_paths'] = [job['file']]
+    else:
+        raise ValueError('job has no folder, file or files')
+
+    # the parameters to label them with
+    config = job.get('config') or {}
+    for name in config:
+        if name not in parameter_names:
+            raise ValueError(f'Unknown parameter {name}')
+    job['parameters'] = {name: globals()[name] for name in parameter_names}
+    job['parameters'].update(config)
+
+    return job
+
+
+async def run_job(job, pool, slots, send):
+    '''
+    dict, dict, asyncio.Semaphore, coroutine function -> None
+
+    Labels the files of a parsed worker job in the worker processes of a pool (see start_pool), sending a result line
+    for each file as it is done (the get_report_record of the file with the job id) and a summary line when the job
+    is finished. The files of all the jobs share the slots, which bound how many files are queued up at once. With
+    warm_start the files are labelled one after another in ply number order, each search starting from the ply before it.
+    If a worker process dies, only the file it was labelling fails: the pool is started again for every job and the
+    other files it hadn't finished are run again (see submit_isolated).
+    '''
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    summary = {'job': job.get('id'), 'done': True, 'files': 0, 'failed': 0}
+    start = time.perf_counter()
+
+    async def label_file(file_path, warm_config=None):
+        args = (run_job_file, job['parameters'], file_path, job['line1'], job['line2'], job['ply_prefix'],
+                warm_config, bool(job.get('placements', False)))
+
+        async with slots:
+            executor = pool['executor']
+            try:
+                result = await loop.run_in_executor(executor, *args)
+            except BrokenProcessPool:
+                # the pool broke while this file was in it, so run it again in a process of its own
+                restart_pool(pool, executor)
+                try:
+                    result = await asyncio.wrap_future(submit_isolated(pool, *args))
+                except Exception as e:
+                    result = get_empty_result(os.path.basename(file_path), 'failed', f'{type(e).__name__}: {e}')
+            except Exception as e:
+                result = get_empty_result(os.path.basename(file_path), 'failed', f'{type(e).__name__}: {e}')
+
+        summary['files'] += 1
+        summary['failed'] += result['status'] == 'failed'
+        await send({'job': job.get('id'), **get_report_record(result)})
+
+        return result
+
+    if job['parameters']['warm_start']:
+        warm_config = None
+        for file_path in sort_by_ply_number(job['file_paths'], job['ply_prefix']):
+            result = await label_file(file_path, warm_config)
+
+            # start the next ply from this one
+            if result['status'] == 'done':
+                warm_config = result['best_config']
+    else:
+        await asyncio.gather(*[label_file(file_path) for file_path in job['file_paths']])
+
+    summary['seconds'] = time.perf_counter() - start
+    await send(summary)
+
+
+async def serve_jobs(read_line, send, pool, slots):
+    '''
+    coroutine function, coroutine function, dict, asyncio.Semaphore -> None
+
+    Reads worker jobs as JSON lines with read_line until it returns an empty line, running each job as soon as
+    it is read (see run_job) and sending its results with send. Jobs that can't be run are answered with
+    a summary line holding the error. Returns once every job is finished.
+    '''
+    import asyncio
+
+    jobs = set()
+
+    while True:
+        line = await read_line()
+        if line == '':
+            break
+        if line.strip() == '':
+            continue
+
+        # answer jobs that can't be run straight away, with their id if they have one
+        job_id = None
+        try:
+            job = json.loads(line)
+            if isinstance(job, dict):
+                job_id = job.get('id')
+            job = parse_job(job)
+        except Exception as e:
+            await send({'job': job_id, 'done': True, 'error': f'{type(e).__name__}: {e}'})
+            continue
+
+        # run the job alongside the others, keeping a reference to it until it is done
+        task = asyncio.create_task(run_job(job, pool, slots, send))
+        jobs.add(task)
+        task.add_done_callback(jobs.discard)
+
+    await asyncio.gather(*jobs)
+
+
+async def serve_stdin(pool, slots):
+    '''
+    dict, asyncio.Semaphore -> None
+
+    Serves worker jobs read from stdin, writing the results to stdout, until stdin is closed.
+    Only the result lines go to stdout, anything else printed meanwhile goes to stderr.
+    '''
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    results = sys.stdout
+
+    async def read_line():
+        # stdin can't be read without blocking, so read it in a thread
+        return await loop.run_in_executor(None, sys.stdin.readline)
+
+    async def send(record):
+        results.write(json.dumps(record) + '\n')
+        results.flush()
+
+    # keep other output from breaking up the JSON lines
+    with redirect_stdout(sys.stderr):
+        await serve_jobs(read_line, send, pool, slots)
+
+
+async def serve_socket(socket_path, pool, slots):
+    '''
+    str, dict, asyncio.Semaphore -> None
+
+    Serves worker jobs on a Unix socket until the worker is stopped. Each connection sends jobs as JSON lines
+    and gets the results of its own jobs back on the same connection.
+    '''
+    import asyncio
+
+    async def handle_connection(reader, writer):
+        async def read_line():
+            return (await reader.readline()).decode()
+
+        async def send(record):
+            writer.write((json.dumps(record) + '\n').encode())
+            await writer.drain()
+
+        try:
+            await serve_jobs(read_line, send, pool, slots)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle_connection, path=socket_path)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(socket_path=None, jobs=1, config=None):
+    '''
+    str, int, dict -> None
+
+    Runs a resident labelling worker that keeps its imports, placement cache and worker processes warm between jobs.
+    Jobs are read as JSON lines (see parse_job) from stdin, or from a Unix socket at socket_path, and the result
+    of every file is streamed back as a JSON line as soon as it is done, followed by a summary line for each job.
+    The jobs run at the same time, sharing a pool of jobs worker processes for the searches.
+    config can override any of the PARAMETER CONTROLS values, and each job's config overrides them again.
+    '''
+    # asyncio is only imported by the worker functions, to keep the script quick to start
+    import asyncio
+
+    with use_parameters(config):
+        # the pool starts its workers as files come in, while stdin is being read in a thread or connections are open.
+        # A worker forked then would hang on the stdin lock held by the reading thread, or hold on to the socket of
+        # a connection and keep it from closing, so they are started from a clean server process instead
+        # (where there is no fork, the default start method already starts them clean)
+        mp_context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+
+        pool = start_pool(jobs, mp_context)
+
+        async def run():
+            # keep every worker busy with a couple of files queued up, whatever the size of the jobs
+            slots = asyncio.Semaphore(2 * jobs)
+
+            if socket_path is None:
+                await serve_stdin(pool, slots)
+            else:
+                await serve_socket(socket_path, pool, slots)
+
+        # replace a socket left behind by a worker that was killed
+        if socket_path is not None and os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+
+        try:
+            asyncio.run(run())
+        finally:
+            pool['executor'].shutdown()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def main(argv=None):
+    '''
+    list(str) -> int
+
+    Command line entry point. Labels every DXF in a folder, asking for any text that isn't given as an argument.
+    With --placements the placements are only found and written to a file, which --apply later labels the folder from.
+    With --serve it runs as a resident worker instead (see serve).
+    Returns the exit status (1 if any file could not be labelled).
+    '''
+    parser = argparse.ArgumentParser(description='Add ply labels to every DXF in a folder')
+    parser.add_argument('folder', nargs='?', help='folder of ply DXFs to label (the files are overwritten)')
+    parser.add_argument('--line1', help='first line text; the ply number from the filename is added to the end')
+    parser.add_argument('--line2', help='second line text')
+    parser.add_argument('--ply-prefix', help="prefix before the ply number in the filenames (e.g. 'L')")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of files to label at once in parallel worker processes (default: 1)')
+    parser.add_argument('--threads', type=int, default=search_threads,
+                        help=f'number of threads searching each ply (default: {search_threads})')
+    parser.add_argument('--search-mode', choices=['adaptive', 'exhaustive', 'raster'], default=search_mode,
+                        help=f'placement search to use (default: {search_mode})')
+    parser.add_argument('--cache', default=cache_path,
+                        help='file to cache placements in, so plies with unchanged geometry are not searched again')
+    parser.add_argument('--warm-start', action='store_true', default=warm_start,
+                        help='label the plies in ply number order, searching around the placement of the ply before')
+    parser.add_argument('--stream', action='store_true', default=stream_read,
+                        help='find the placements from only the labelling layers streamed out of each file')
+    parser.add_argument('--clearance', type=float, default=clearance,
+                        help=f'distance to keep the labels from the rosette and markers (default: {clearance})')
+    parser.add_argument('--time-limit', type=float, default=search_time_limit,
+                        help='seconds the search of each ply may take before it stops at the best placement found so far')
+    parser.add_argument('--check-limit', type=int, default=search_check_limit,
+                        help='rectangle checks the search of each ply may make before it stops at the best placement found so far')
+    parser.add_argument('--report',
+                        help='JSON lines file to write the timings, counters and search quality of every file to, '
+                             'with a batch summary at the end')
+    parser.add_argument('--profile', default=profile_path,
+                        help='folder to save a cProfile of every file to')
+    parser.add_argument('--journal', nargs='?', const='',
+                        help='JSON lines file to journal the batch in, so running it again skips the files already done '
+                             f'(default when given without a file: {journal_filename} in the folder)')
+    parser.add_argument('--serve', action='store_true',
+                        help='run as a resident worker, reading JSON lines jobs from stdin and writing the results to stdout')
+    parser.add_argument('--socket',
+                        help='with --serve, read the jobs from and write the results to connections on this Unix socket')
+    stages = parser.add_mutually_exclusive_group()
+    stages.add_argument('--placements',
+                        help='only find the placements and write them to this JSON lines file, leaving the files as they are')
+    stages.add_argument('--apply',
+                        help='label the files from the placements in this JSON lines file without searching; '
+                             '--line1 and --line2 replace the text of the placements')
+    args = parser.parse_args(argv)
+
+    config = {'search_threads': args.threads,
+              'search_mode': args.search_mode,
+              'cache_path': args.cache,
+              'profile_path': args.profile,
+              'stream_read': args.stream,
+              'warm_start': args.warm_start,
+              'clearance': args.clearance,
+              'search_time_limit': args.time_limit,
+              'search_check_limit': args.check_limit}
+
+    # a resident worker gets its folders and text from its jobs
+    if args.serve:
+        try:
+            serve(args.socket, args.jobs, config)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.folder is None:
+        parser.error('a folder is needed unless running with --serve')
+    if not os.path.isdir(args.folder):
+        parser.error(f'the folder at {args.folder} does not exist')
+    if args.journal is not None and args.apply is not None:
+        parser.error('--journal can not be used with --apply')
+
+    # the journal is kept in the folder unless another file is given
+    journal_path = args.journal
+    if journal_path == '':
+        journal_path = os.path.join(args.folder, journal_filename)
+
+    # written on the first line of text on each ply
+    line1_text = args.line1
+    if line1_text is None and args.apply is None:
+        line1_text = input("First line text (Digits following L will be replaced by ply number from filenames):")
+
+    # ply prefix that will be used to find the ply number
+    ply_prefix = args.ply_prefix
+    if ply_prefix is None and line1_text is not None:
+        ply_prefix = input("ply prefix in filenames(e.g. 'L'):")
+
+    # written on the second line of text on each ply
+    line2_text = args.line2
+    if line2_text is None and args.apply is None:
+        line2_text = input("Second line text:")
+
+    #----ITERATE OVER EACH FILE----
+    num_done = 0
+    num_skipped = 0
+    num_files = 0
+    total_timings = {}
+    total_counters = {}
+    coverages = []
+    height_ratios = []
+    start = time.perf_counter()
+
+    if args.apply is not None:
+        # write the text from the placements file
+        results = apply_placements(args.folder, args.apply, line1_text, line2_text, ply_prefix, config)
+    else:
+        # read, label and save each dxf in the folder as its turn comes (or only find its placement)
+        results = label_folder(args.folder, line1_text, line2_text, ply_prefix, config, args.jobs,
+                               compute_only=args.placements is not None, journal_path=journal_path)
+
+    with (open(args.report, 'w') if args.report is not None else nullcontext()) as report, \
+         (open(args.placements, 'w') if args.placements is not None else nullcontext()) as placements:
+        for result in results:
+            num_files += 1
+
+            # report the files that could not be labelled
+            if result['status'] == 'failed':
+                print(f"Could not label {result['filename']}: {result['error']}")
+            else:
+                num_done += 1
+
+            # files the journal records as already done count as done
+            if result['status'] == 'skipped':
+                num_skipped += 1
+
+            # add the file to the run report and the batch totals
+            for stage, seconds in result['timings'].items():
+                total_timings[stage] = total_timings.get(stage, 0) + seconds
+            for name, count in result['counters'].items():
+                total_counters[name] = total_counters.get(name, 0) + count
+            if 'coverage' in result.get('quality', {}):
+                coverages.append(result['quality']['coverage'])
+                height_ratios.append(result['quality']['height_ratio'])
+
+            if report is not None:
+                report.write(get_report_line(result) + '\n')
+                report.flush()
+
+            if placements is not None:
+                placements.write(get_placement_line(result) + '\n')
+                placements.flush()
+
+        if report is not None:
+            report.write(json.dumps({'batch': {'files': num_files,
+                                               'done': num_done,
+                                               'failed': num_files - num_done,
+                                               'skipped': num_skipped,
+                                               'jobs': args.jobs,
+                                               'seconds': time.perf_counter() - start,
+                                               'timings': total_timings,
+                                               'counters': total_counters,
+                                               # the least searched ply and the label furthest below its upper bound
+                                               'min_coverage': min(coverages, default=None),
+                                               'min_height_ratio': min(height_ratios, default=None)}}) + '\n')
+
+    if args.placements is not None:
+        print(f"Placed {num_done} of {num_files} files")
+    else:
+        print(f"Labelled {num_done} of {num_files} files")
+
+    if num_skipped != 0:
+        print(f"{num_skipped} files were already done in the journal")
+
+    print('DONE.')
+
+    return 0 if num_done == num_files else 1
+
+
+#----PARAMETER CONTROLS---- 
+# number of test grid points along the x-axis of the ply bounding box
+num_x = 10
+
+# number of test grid points along the y-axis of the ply bounding box
+num_y = 10
+
+# smallest rectangle height considered by the placement search
+min_rect_height = 0.51
+
+# the rectangle height is bisected until it is known to within this tolerance (drawing units)
+height_tolerance = 0.01
+
+# number of rectangle angle stages
+angle_resolution = 30
+
+# spread the search grid points over the inside of the ply (minus the rosette and markers) instead of its bounding box
+sample_inside = True
+
+# placement search to use: 'exhaustive' tries every grid point, scale and angle below,
+# 'adaptive' runs a coarse pass and refines around the best configurations,
+# 'raster' finds the largest rectangle at each angle on a raster of the ply
+search_mode = 'adaptive'
+
+# number of raster cells along the longer side of the ply for the raster search
+raster_resolution = 200
+
+# number of coarse grid points along each axis of the ply bounding box for the adaptive search
+adaptive_grid = 6
+
+# number of coarse rectangle angle stages for the adaptive search
+adaptive_angles = 12
+
+# number of configurations the adaptive search keeps and refines
+adaptive_top_k = 5
+
+# the adaptive search stops when its position step (drawing units) and angle step (degrees) are below these
+adaptive_tolerance = 0.05
+adaptive_angle_tolerance = 0.5
+
+# label the plies of a batch in ply number order and start each search from the placement of the ply before,
+# only searching its neighbourhood if it still fits (adjacent plies of a stack usually have almost the same outline)
+warm_start = False
+
+# the placement of the ply before still counts as fitting if it fits shrunk to this fraction of its height
+warm_start_shrink = 0.9
+
+# number of threads that share the placement search of a single ply
+search_threads = 1
+
+# seconds and rectangle checks the search of a ply may take before it stops at the best placement found so far (None for no limit).
+# The searches check the budget between rounds, so a ply can run over by one round of checks
+search_time_limit = None
+search_check_limit = None
+
+# maximum number of candidate rectangles built and checked at once by the nesting loop (bounds memory use)
+search_batch_size = 20000
+
+# padding between text fit rectangle and text
+padding = 0.5
+
+# linespacing
+line_space = 0.1
+
+# max text height
+max_text_height = 1
+
+# character aspect ratio
+char_ratio = 0.77
+
+# smallest distance (drawing units) kept between the label's fitting rectangle and the rosette and markers
+clearance = 0.0
+
+# Tell the script which layer names are required to process a ply
+required_layers = ['OUTER', 'ROSETTE']
+
+# Tell the script how far curve slices may be from the curves they replace (drawing units)
+chord_error = 0.01
+
+# Tell the script how far the search polygon's vertices may move when it is simplified (drawing units, 0 to turn off).
+# The polygon is first shrunk by chord_error + simplify_tolerance so labels can't cross the true edge.
+simplify_tolerance = 0.02
+
+# Tell the script how many digits should be considered when comparing point locations
+round_digits = 6
+
+# file to keep found placements in between runs so unchanged plies aren't searched again (None to turn off)
+cache_path = None
+
+# maximum number of placements kept in the cache (the least recently used are dropped first)
+cache_size = 10000
+
+# find placements from only the labelling layers streamed out of each file, loading the whole file only to write the text.
+# The file is read twice, so this only pays off when many plies fail or when only the placements are needed
+stream_read = False
+
+# folder to save a cProfile of every file to (None to turn off)
+profile_path = None
+
+# name of the batch journal kept in the folder when --journal is given without a file (hidden, so it isn't read as a ply)
+journal_filename = '.dxf_labeller_journal.jsonl'
+
+# parameters that change the placement search result, and so are part of each placement cache key
+search_parameter_names = ['num_x', 'num_y', 'min_rect_height', 'height_tolerance', 'angle_resolution', 'sample_inside',
+                          'search_mode', 'raster_resolution', 'adaptive_grid', 'adaptive_angles', 'adaptive_top_k',
+                          'adaptive_tolerance', 'adaptive_angle_tolerance', 'warm_start', 'warm_start_shrink',
+                          'search_threads', 'clearance', 'chord_error', 'simplify_tolerance', 'round_digits']
+
+# parameters that can be overridden by a config and are passed on to worker processes
+parameter_names = ['num_x', 'num_y', 'min_rect_height', 'height_tolerance', 'angle_resolution', 'sample_inside',
+                   'search_mode', 'raster_resolution', 'adaptive_grid', 'adaptive_angles', 'adaptive_top_k',
+                   'adaptive_tolerance', 'adaptive_angle_tolerance', 'warm_start', 'warm_start_shrink', 'search_threads',
+                   'search_time_limit', 'search_check_limit', 'search_batch_size', 'padding', 'line_space', 'max_text_height',
+                   'char_ratio', 'clearance', 'required_layers', 'chord_error', 'simplify_tolerance', 'round_digits', 'cache_path', 'cache_size', 'profile_path', 'stream_read']
+
+# stage timings (seconds), counters and search quality of the ply being labelled, collected by timed, count_stats and set_quality
+stats = {'timings': {}, 'counters': {}, 'quality': {}}
+stats_lock = threading.Lock()
+
+# deadline, counters at the start and state of the search budget of the ply being searched, set by start_search_budget
+search_budget = {'deadline': None, 'counters': {}, 'expired': False}
+
+
+#----SCRIPT----
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,238 @@
+#----IMPORT NEEDED LIBRARIES----
+import math, os, random
+import argparse
+
+import ezdxf
+
+
+#----FUNCTION DEFINITIONS----
+
+def new_ply_doc():
+    '''
+    None -> ezdxf.document.Drawing
+
+    Makes an empty DXF with the layers the labelling script reads, and some old text to replace
+    '''
+    doc = ezdxf.new()
+    for layer_name in ['OUTER', 'INNER', 'ROSETTE', 'MARKERS']:
+        doc.layers.add(layer_name)
+
+    doc.modelspace().add_text('OLD LABEL', dxfattribs={'height': 1})
+
+    return doc
+
+
+def add_rosette(msp, location, size):
+    '''
+    ezdxf.layouts.layout.Modelspace, tuple, float -> None
+
+    Draws an open L shaped rosette with its corner at location
+    '''
+    x, y = location
+    msp.add_lwpolyline([(x + size, y), (x, y), (x, y + size)], dxfattribs={'layer': 'ROSETTE'})
+
+
+def add_markers(msp, points, size):
+    '''
+    ezdxf.layouts.layout.Modelspace, list(tuple), float -> None
+
+    Draws a short marker tick at each point, each one its own MARKERS polyline
+    '''
+    for x, y in points:
+        msp.add_lwpolyline([(x, y - size / 2), (x, y + size / 2)], dxfattribs={'layer': 'MARKERS'})
+
+
+def add_outline(msp, vertices, exploded=False, rng=None):
+    '''
+    ezdxf.layouts.layout.Modelspace, list(tuple), bool, random.Random -> None
+
+    Draws a closed outline on the OUTER layer, either as one LWPOLYLINE or exploded into shuffled LINE entities
+    with random directions, like outlines from our CAD export
+    '''
+    if not exploded:
+        msp.add_lwpolyline(vertices, close=True, dxfattribs={'layer': 'OUTER'})
+        return
+
+    segments = [(vertices[i], vertices[(i + 1) % len(vertices)]) for i in range(len(vertices))]
+    rng.shuffle(segments)
+
+    for start, end in segments:
+        if rng.random() < 0.5:
+            start, end = end, start
+        msp.add_line(start, end, dxfattribs={'layer': 'OUTER'})
+
+
+def wavy_outline(width, height, num_vertices, rng):
+    '''
+    float, float, int, random.Random -> list(tuple)
+
+    Makes the vertices of a blob shaped outline that fits in a width x height box
+    '''
+    phases = [rng.uniform(0, 2 * math.pi) for i in range(3)]
+    vertices = []
+
+    for i in range(num_vertices):
+        t = 2 * math.pi * i / num_vertices
+        r = 1 + 0.08 * math.sin(3 * t + phases[0]) + 0.05 * math.sin(5 * t + phases[1]) + 0.03 * math.sin(7 * t + phases[2])
+        vertices.append((width / 2 * (1 + r * math.cos(t) * 0.9), height / 2 * (1 + r * math.sin(t) * 0.9)))
+
+    return vertices
+
+
+def make_rectangle(scale, detail, rng):
+    '''
+    float, int, random.Random -> ezdxf.document.Drawing
+
+    Plain rectangle with the rosette in a corner
+    '''
+    doc = new_ply_doc()
+    msp = doc.modelspace()
+    add_outline(msp, [(0, 0), (40 * scale, 0), (40 * scale, 25 * scale), (0, 25 * scale)])
+    add_rosette(msp, (2 * scale, 2 * scale), 3 * scale)
+    return doc
+
+
+def make_l_shape(scale, detail, rng):
+    '''
+    float, int, random.Random -> ezdxf.document.Drawing
+
+    L shaped ply with the rosette in one leg and markers in both
+    '''
+    doc = new_ply_doc()
+    msp = doc.modelspace()
+    add_outline(msp, [(0, 0), (60 * scale, 0), (60 * scale, 12 * scale), (12 * scale, 12 * scale),
+                      (12 * scale, 50 * scale), (0, 50 * scale)])
+    add_rosette(msp, (30 * scale, 3 * scale), 3 * scale)
+    add_markers(msp, [(45 * scale, 6 * scale), (6 * scale, 30 * scale)], 2 * scale)
+    return doc
+
+
+def make_strip(scale, detail, rng):
+    '''
+    float, int, random.Random -> ezdxf.document.Drawing
+
+    Long slender strip at 30 degrees
+    '''
+    doc = new_ply_doc()
+    msp = doc.modelspace()
+    theta = math.radians(30)
+    corners = [(0, 0), (200 * scale, 0), (200 * scale, 6 * scale), (0, 6 * scale)]
+    add_outline(msp, [(x * math.cos(theta) - y * math.sin(theta), x * math.sin(theta) + y * math.cos(theta))
+                      for x, y in corners])
+    add_rosette(msp, (10 * scale * math.cos(theta), 10 * scale * math.sin(theta) + 1 * scale), 2 * scale)
+    return doc
+
+
+def make_holes(scale, detail, rng):
+    '''
+    float, int, random.Random -> ezdxf.document.Drawing
+
+    Rectangle with three circular holes on the INNER layer
+    '''
+    doc = new_ply_doc()
+    msp = doc.modelspace()
+    add_outline(msp, [(0, 0), (80 * scale, 0), (80 * scale, 50 * scale), (0, 50 * scale)])
+    for center, radius in [((20, 25), 8), ((50, 15), 6), ((60, 38), 7)]:
+        msp.add_circle((center[0] * scale, center[1] * scale), radius * scale, dxfattribs={'layer': 'INNER'})
+    add_rosette(msp, (70 * scale, 3 * scale), 4 * scale)
+    add_markers(msp, [(35 * scale, 45 * scale)], 3 * scale)
+    return doc
+
+
+def make_curved(scale, detail, rng):
+    '''
+    float, int, random.Random -> ezdxf.document.Drawing
+
+    Outline built from an ARC, a LINE and a wavy SPLINE joined end to end
+    '''
+    doc = new_ply_doc()
+    msp = doc.modelspace()
+    width, height = 70 * scale, 40 * scale
+
+    # left end is a half circle
+    arc = msp.add_arc((height / 2, height / 2), height / 2, 90, 270, dxfattribs={'layer': 'OUTER'})
+    start = (arc.start_point.x, arc.start_point.y)
+    end = (arc.end_point.x, arc.end_point.y)
+
+    # bottom edge is a line, the top and right edges are one wavy spline
+    msp.add_line(end, (width, 0), dxfattribs={'layer': 'OUTER'})
+    fit_points = [(width, 0), (width + 6 * scale, height / 2), (width, height)]
+    for i in range(1, 4 * detail):
+        x = width - (width - start[0]) * i / (4 * detail)
+        fit_points.append((x, height + 3 * scale * math.sin(i)))
+    fit_points.append(start)
+    msp.add_spline(fit_points, dxfattribs={'layer': 'OUTER'})
+
+    add_rosette(msp, (width - 10 * scale, 4 * scale), 3 * scale)
+    add_markers(msp, [(width / 2, height / 2)], 4 * scale)
+    return doc
+
+
+def make_exploded(scale, detail, rng):
+    '''
+    float, int, random.Random -> ezdxf.document.Drawing
+
+    Blob outline exploded into hundreds of LINE segments in random order
+    '''
+    doc = new_ply_doc()
+    msp = doc.modelspace()
+    add_outline(msp, wavy_outline(90 * scale, 60 * scale, 400 * detail, rng), exploded=True, rng=rng)
+    add_rosette(msp, (45 * scale, 30 * scale), 4 * scale)
+    return doc
+
+
+def make_offset_rosette(scale, detail, rng):
+    '''
+    float, int, random.Random -> ezdxf.document.Drawing
+
+    Blob outline with the rosette and markers at random places inside it
+    '''
+    doc = new_ply_doc()
+    msp = doc.modelspace()
+    add_outline(msp, wavy_outline(70 * scale, 45 * scale, 200 * detail, rng))
+    add_rosette(msp, (rng.uniform(20, 50) * scale, rng.uniform(12, 33) * scale), 3 * scale)
+    add_markers(msp, [(rng.uniform(20, 50) * scale, rng.uniform(12, 33) * scale) for i in range(3)], 2 * scale)
+    return doc
+
+
+# every synthetic ply shape, by name
+PLY_MAKERS = {'rectangle': make_rectangle,
+              'l_shape': make_l_shape,
+              'strip': make_strip,
+              'holes': make_holes,
+              'curved': make_curved,
+              'exploded': make_exploded,
+              'offset_rosette': make_offset_rosette}
+
+
+def generate_plies(folder_path, scale=1, detail=1, seed=0):
+    '''
+    str, float, int, int -> list(str)
+
+    Writes one synthetic ply DXF of each shape in PLY_MAKERS to a folder, named like real plies (BENCH_L<n>_<shape>.dxf).
+    scale multiplies the ply dimensions and detail multiplies the number of vertices/segments in the outlines.
+    The same seed always gives the same plies. Returns the paths of the files.
+    '''
+    os.makedirs(folder_path, exist_ok=True)
+    rng = random.Random(seed)
+
+    file_paths = []
+    for ply_number, (name, make_ply) in enumerate(PLY_MAKERS.items(), start=1):
+        file_path = os.path.join(folder_path, f'BENCH_L{ply_number}_{name}.dxf')
+        make_ply(scale, detail, rng).saveas(file_path)
+        file_paths.append(file_path)
+
+    return file_paths
+
+
+#----SCRIPT----
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic ply DXFs for benchmarking the labelling script')
+    parser.add_argument('folder', help='folder to write the plies to')
+    parser.add_argument('--scale', type=float, default=1, help='multiplies the ply dimensions (default: 1)')
+    parser.add_argument('--detail', type=int, default=1, help='multiplies the number of outline segments (default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+
+    for file_path in generate_plies(args.folder, args.scale, args.detail, args.seed):
+        print(file_path)
@@ -0,0 +1,170 @@
+#----IMPORT NEEDED LIBRARIES----
+import os, sys, json, time, tempfile
+import argparse
+
+import ezdxf
+# the labelling script lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DXF_LABELLER as labeller
+
+from generate_plies import generate_plies
+
+
+#----FUNCTION DEFINITIONS----
+
+def benchmark_ply(file_path, line1_text, line2_text, ply_prefix, output_path):
+    '''
+    str, str, str, str, str -> dict
+
+    Labels one ply stage by stage, timing each stage. Returns the stage times (seconds), the vertex count
+    of the search geometry (the free region the search checks rectangles against) and the achieved rectangle height.
+    '''
+    timings = {}
+    filename = os.path.basename(file_path)
+
+    # read the file
+    start = time.perf_counter()
+    doc = ezdxf.readfile(file_path)
+    msp = doc.modelspace()
+    timings['read'] = time.perf_counter() - start
+
+    # read and stitch the geometry
+    start = time.perf_counter()
+    layer_vertices = labeller.get_layer_vertices(msp, ['OUTER', 'INNER', 'ROSETTE', 'MARKERS'])
+    timings['vertices'] = time.perf_counter() - start
+
+    # prepare the geometry and find the placement
+    line1_text = line1_text + labeller.get_ply_number(filename, ply_prefix)
+
+    labeller.reset_stats()
+    start = time.perf_counter()
+    best_config, cached = labeller.find_placement(layer_vertices, line1_text, line2_text)
+    timings['search'] = time.perf_counter() - start
+
+    # write the text and save with the labelling script's own functions
+    start = time.perf_counter()
+    labeller.write_label(msp, best_config, line1_text, line2_text)
+    labeller.save_doc(doc, output_path)
+    timings['write'] = time.perf_counter() - start
+
+    return {'timings': timings,
+            'vertices': labeller.stats['counters']['search_vertices'],
+            'label_height': float(best_config[1])}
+
+
+def run_benchmarks(scale=1, detail=1, repeat=5, seed=0):
+    '''
+    float, int, int, int -> dict
+
+    Generates the synthetic plies and labels each one repeat times, keeping the fastest time of each stage.
+    Returns a dict of results by ply name.
+    '''
+    results = {}
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        for file_path in generate_plies(folder_path, scale, detail, seed):
+            name = os.path.basename(file_path)[:-4].split('_', 2)[2]
+
+            runs = [benchmark_ply(file_path, 'L', 'JOB', 'L', os.path.join(folder_path, 'out.dxf')) for i in range(repeat)]
+
+            results[name] = {'timings': {stage: min(run['timings'][stage] for run in runs) for stage in runs[0]['timings']},
+                             'vertices': runs[0]['vertices'],
+                             'label_height': runs[0]['label_height']}
+
+    return results
+
+
+def compare_to_baseline(results, baseline, time_tolerance, height_tolerance, time_floor=0.01):
+    '''
+    dict, dict, float, float, float -> list(str)
+
+    Returns a message for every stage that got slower than the baseline by more than time_tolerance (a fraction)
+    and more than time_floor seconds (so timer noise on fast stages isn't reported), and every ply whose
+    label height got smaller by more than height_tolerance (a fraction)
+    '''
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for stage, seconds in result['timings'].items():
+            baseline_seconds = baseline[name]['timings'].get(stage)
+            if baseline_seconds is None:
+                continue
+
+            if seconds > baseline_seconds * (1 + time_tolerance) and seconds > baseline_seconds + time_floor:
+                regressions.append(f'{name}: {stage} took {seconds * 1000:.1f} ms (baseline {baseline_seconds * 1000:.1f} ms)')
+
+        baseline_height = baseline[name]['label_height']
+        if result['label_height'] < baseline_height * (1 - height_tolerance):
+            regressions.append(f"{name}: label height {result['label_height']:.3f} (baseline {baseline_height:.3f})")
+
+    return regressions
+
+
+def print_results(results):
+    '''
+    dict -> None
+
+    Prints a table of stage times (ms), vertex counts and label heights, with the throughput of each stage over all plies
+    '''
+    stages = list(next(iter(results.values()))['timings'])
+
+    print(f"{'ply':<16}" + ''.join(f'{stage:>10}' for stage in stages) + f"{'vertices':>10}{'height':>10}")
+    for name, result in results.items():
+        print(f'{name:<16}'
+              + ''.join(f"{result['timings'][stage] * 1000:>10.1f}" for stage in stages)
+              + f"{result['vertices']:>10}{result['label_height']:>10.3f}")
+
+    # plies per second through each stage
+    print(f"{'plies/s':<16}"
+          + ''.join(f"{len(results) / sum(result['timings'][stage] for result in results.values()):>10.1f}"
+                    for stage in stages))
+
+
+#----SCRIPT----
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the labelling script on synthetic plies')
+    parser.add_argument('--scale', type=float, default=1, help='multiplies the ply dimensions (default: 1)')
+    parser.add_argument('--detail', type=int, default=1, help='multiplies the number of outline segments (default: 1)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per ply, the fastest is kept (default: 5)')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'),
+                        help='baseline file to compare against (default: benchmarks/baseline.json)')
+    parser.add_argument('--update-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--time-tolerance', type=float, default=0.25,
+                        help='fraction a stage may get slower before it counts as a regression (default: 0.25)')
+    parser.add_argument('--time-floor', type=float, default=0.01,
+                        help='seconds a stage may get slower before it counts as a regression (default: 0.01)')
+    parser.add_argument('--height-tolerance', type=float, default=0.01,
+                        help='fraction a label may get smaller before it counts as a regression (default: 0.01)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scale, args.detail, args.repeat)
+    print_results(results)
+
+    # baselines are kept per size setting
+    baseline_key = f'scale={args.scale:g},detail={args.detail}'
+    baselines = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines[baseline_key] = results
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Stored baseline {baseline_key} in {args.baseline}')
+
+    elif baseline_key in baselines:
+        regressions = compare_to_baseline(results, baselines[baseline_key],
+                                          args.time_tolerance, args.height_tolerance, args.time_floor)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+
+        if len(regressions) != 0:
+            sys.exit(1)
+        print(f'No regressions against baseline {baseline_key}')
+
+    else:
+        print(f'No baseline stored for {baseline_key}, run with --update-baseline to store one')
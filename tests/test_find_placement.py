@@ -0,0 +1,48 @@
+#----IMPORT NEEDED LIBRARIES----
+import os, sys
+
+import pytest
+
+# the labelling script lives in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import DXF_LABELLER as labeller
+
+
+#----FUNCTION DEFINITIONS----
+
+def strip_vertices(width):
+    '''
+    float -> dict
+
+    Makes the get_layer_vertices of a long strip width wide, with a short rosette near one end
+    '''
+    return {'OUTER': [(0, 0), (30, 0), (30, width), (0, width)],
+            'INNER': [],
+            'ROSETTE': [(1, 0.1), (1.2, 0.1)],
+            'MARKERS': []}
+
+
+#----TESTS----
+
+@pytest.mark.parametrize('width', [0.53, 0.56])
+def test_narrow_strip_is_labelled(width):
+    # the shrunk and simplified search polygon leaves no room for the smallest rectangle in these strips,
+    # so the label has to come from searching the full polygon
+    best_config, cached = labeller.find_placement(strip_vertices(width), 'L1', 'JOB')
+
+    with labeller.use_parameters({'simplify_tolerance': 0}):
+        full_config, cached = labeller.find_placement(strip_vertices(width), 'L1', 'JOB')
+
+    assert labeller.min_rect_height <= best_config[1] < width
+    assert best_config[1] == pytest.approx(full_config[1], abs=labeller.height_tolerance)
+
+
+def test_budget_keeps_inscribed_rectangle():
+    # a search that runs out of checks still returns the rectangle inscribed in the largest circle,
+    # not the smallest label
+    layer_vertices = strip_vertices(6)
+    with labeller.use_parameters({'search_check_limit': 50}):
+        best_config, cached = labeller.find_placement(layer_vertices, 'L1', 'JOB')
+
+    assert best_config[1] > labeller.min_rect_height
+    assert best_config[1] > 2
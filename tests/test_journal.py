@@ -0,0 +1,100 @@
+#----IMPORT NEEDED LIBRARIES----
+import os, sys, shutil
+
+# the labelling script lives in the folder above, and the ply generator in the benchmarks folder
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_path)
+sys.path.insert(0, os.path.join(root_path, 'benchmarks'))
+import DXF_LABELLER as labeller
+from generate_plies import generate_plies
+
+
+#----FUNCTION DEFINITIONS----
+
+def run_batch(folder_path, journal_path):
+    '''
+    str, str -> dict
+
+    Labels the folder with a journal, returning the status of each file by filename
+    '''
+    return {result['filename']: result['status']
+            for result in labeller.label_folder(folder_path, 'L1', 'JOB', 'L', journal_path=journal_path)}
+
+
+def make_batch(tmp_path):
+    '''
+    pathlib.Path -> str, str, list(str)
+
+    Generates the benchmark plies in a folder, keeping unlabelled copies of them outside it.
+    Returns the folder, the journal path and the filenames of the plies.
+    '''
+    folder_path = tmp_path / 'plies'
+    original_path = tmp_path / 'originals'
+    folder_path.mkdir()
+
+    file_paths = generate_plies(str(folder_path))
+    shutil.copytree(folder_path, original_path)
+
+    return str(folder_path), str(tmp_path / 'journal.jsonl'), [os.path.basename(file_path) for file_path in file_paths]
+
+
+#----TESTS----
+
+def test_done_files_are_skipped(tmp_path):
+    folder_path, journal_path, filenames = make_batch(tmp_path)
+
+    first = run_batch(folder_path, journal_path)
+    assert first == {filename: 'done' for filename in filenames}
+
+    second = run_batch(folder_path, journal_path)
+    assert second == {filename: 'skipped' for filename in filenames}
+
+
+def test_failed_and_modified_files_are_rerun(tmp_path):
+    folder_path, journal_path, filenames = make_batch(tmp_path)
+
+    # a file that can not be read fails
+    junk_path = os.path.join(folder_path, 'BENCH_L9_junk.dxf')
+    with open(junk_path, 'w') as f:
+        f.write('not a dxf')
+
+    first = run_batch(folder_path, journal_path)
+    assert first['BENCH_L9_junk.dxf'] == 'failed'
+
+    # fix the failed file, and put back the unlabelled version of a done one
+    shutil.copy(os.path.join(tmp_path, 'originals', filenames[0]), junk_path)
+    shutil.copy(os.path.join(tmp_path, 'originals', filenames[1]), os.path.join(folder_path, filenames[1]))
+
+    second = run_batch(folder_path, journal_path)
+    assert second['BENCH_L9_junk.dxf'] == 'done'
+    assert second[filenames[1]] == 'done'
+    assert all(second[filename] == 'skipped' for filename in filenames if filename != filenames[1])
+
+    # once they are done again they are skipped too
+    third = run_batch(folder_path, journal_path)
+    assert set(third.values()) == {'skipped'}
+
+
+def test_truncated_journal_line(tmp_path):
+    folder_path, journal_path, filenames = make_batch(tmp_path)
+    run_batch(folder_path, journal_path)
+
+    # a process killed while writing a record leaves half a line at the end
+    with open(journal_path, 'a') as f:
+        f.write('{"filename": "' + filenames[0] + '", "batch": "')
+
+    assert sorted(labeller.read_journal(journal_path)) == sorted(filenames)
+
+    # the batch still resumes from the journal, and the next record starts on a line of its own
+    shutil.copy(os.path.join(tmp_path, 'originals', filenames[0]), os.path.join(folder_path, filenames[0]))
+
+    second = run_batch(folder_path, journal_path)
+    assert second[filenames[0]] == 'done'
+    assert all(second[filename] == 'skipped' for filename in filenames[1:])
+
+    with open(journal_path) as f:
+        lines = f.read().splitlines()
+    assert lines[-2].endswith('"batch": "')
+    assert lines[-1].startswith('{"filename": "' + filenames[0] + '"')
+    assert labeller.read_journal(journal_path)[filenames[0]]['status'] == 'done'
+    assert set(run_batch(folder_path, journal_path).values()) == {'skipped'}
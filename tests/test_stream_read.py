@@ -0,0 +1,85 @@
+#----IMPORT NEEDED LIBRARIES----
+import os, sys
+
+import ezdxf
+import pytest
+
+# the labelling script lives in the folder above, and the ply generator in the benchmarks folder
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_path)
+sys.path.insert(0, os.path.join(root_path, 'benchmarks'))
+import DXF_LABELLER as labeller
+from generate_plies import generate_plies
+
+
+#----PARAMETER CONTROLS----
+
+layer_names = ['OUTER', 'INNER', 'ROSETTE', 'MARKERS']
+
+
+#----FUNCTION DEFINITIONS----
+
+def write_mixed_ply(file_path, dxfversion):
+    '''
+    str, str -> None
+
+    Writes a ply in the given DXF version using each kind of entity the stream reader keeps, with some it has to skip
+    '''
+    doc = ezdxf.new(dxfversion)
+    for layer_name in layer_names + ['OTHER']:
+        doc.layers.add(layer_name)
+    msp = doc.modelspace()
+
+    # an old style POLYLINE outline, with its VERTEX and SEQEND entities
+    msp.add_polyline2d([(0, 0), (40, 0), (40, 20), (0, 20)], close=True, dxfattribs={'layer': 'OUTER'})
+
+    # a hole of each kind, LWPOLYLINE only from R2000
+    msp.add_circle((10, 10), 2, dxfattribs={'layer': 'INNER'})
+    if dxfversion != 'R12':
+        msp.add_lwpolyline([(25, 5), (30, 5), (30, 8), (25, 8)], close=True, dxfattribs={'layer': 'inner'})
+
+    msp.add_line((2, 2), (2, 4), dxfattribs={'layer': 'ROSETTE'})
+    msp.add_line((2, 2), (4, 2), dxfattribs={'layer': 'ROSETTE'})
+    msp.add_line((20, 0), (20, 1), dxfattribs={'layer': 'MARKERS'})
+
+    # entities that must be skipped: other layers, and wanted layers in paperspace
+    msp.add_polyline2d([(50, 50), (60, 50), (60, 60)], dxfattribs={'layer': 'OTHER'})
+    msp.add_text('OLD LABEL', dxfattribs={'layer': 'OTHER', 'height': 1})
+    doc.paperspace().add_polyline2d([(0, 0), (5, 0), (5, 5)], close=True, dxfattribs={'layer': 'OUTER'})
+    doc.paperspace().add_line((0, 0), (3, 3), dxfattribs={'layer': 'ROSETTE'})
+
+    doc.saveas(file_path)
+
+
+def assert_same_vertices(file_path):
+    '''
+    str -> None
+
+    Checks that the stream reader finds the same layers and vertices as reading the whole file with ezdxf
+    '''
+    layer_list, entities = labeller.read_layer_entities(file_path, layer_names)
+    doc = ezdxf.readfile(file_path)
+
+    assert sorted(layer_list) == sorted(layer.dxf.name for layer in doc.layers)
+    layer_vertices = labeller.get_layer_vertices(entities, layer_names)
+    assert layer_vertices == labeller.get_layer_vertices(doc.modelspace(), layer_names)
+    assert len(layer_vertices['OUTER']) != 0 and len(layer_vertices['ROSETTE']) != 0
+
+
+#----TESTS----
+
+def test_generated_plies(tmp_path):
+    for file_path in generate_plies(str(tmp_path)):
+        assert_same_vertices(file_path)
+
+
+@pytest.mark.parametrize('dxfversion', ['R12', 'R2000', 'R2018'])
+def test_mixed_entities(tmp_path, dxfversion):
+    file_path = str(tmp_path / f'MIXED_{dxfversion}.dxf')
+    write_mixed_ply(file_path, dxfversion)
+
+    assert_same_vertices(file_path)
+
+    # the paperspace and other layer entities are not read
+    layer_list, entities = labeller.read_layer_entities(file_path, layer_names)
+    assert len(entities) == (5 if dxfversion == 'R12' else 6)